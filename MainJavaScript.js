@@ -90,16 +90,23 @@ document.getElementById('catalog-form').addEventListener('submit', function(even
         return;
     }
 
+    const params = new URLSearchParams({
+        'Catalog': selectedCatalog,
+        'user_id': userId
+    });
+    // Optional per-parameter scaling so tempo and loudness don't outweigh everything else
+    const scaleInput = document.getElementById('scale-standard');
+    if (scaleInput && scaleInput.checked) {
+        params.append('Scale', scaleInput.value);
+    }
+
     // Make an AJAX request to the Flask route
     fetch(`https://seamusmcn-github-io.onrender.com/most_similar_song`, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/x-www-form-urlencoded',
         },
-        body: new URLSearchParams({
-            'Catalog': selectedCatalog,
-            'user_id': userId
-        }).toString(),
+        body: params.toString(),
     })
     .then(response => {
         if (!response.ok) {
@@ -117,6 +124,222 @@ document.getElementById('catalog-form').addEventListener('submit', function(even
     });
 });
 
+// Handle Chain Button Click (uses the catalog picked in the form above)
+document.getElementById('chain-button').addEventListener('click', function() {
+    const checked = document.querySelector('input[name="Catalog"]:checked');
+    if (!checked) {
+        document.getElementById('status').innerText = 'Please select a catalog type.';
+        return;
+    }
+
+    const userId = localStorage.getItem('user_id');
+    if (!userId) {
+        document.getElementById('status').innerText = 'Please authenticate first.';
+        return;
+    }
+
+    const params = new URLSearchParams({
+        'Catalog': checked.value,
+        'user_id': userId,
+        'n_songs': document.getElementById('chain-length').value
+    });
+    const scaleInput = document.getElementById('scale-standard');
+    if (scaleInput && scaleInput.checked) {
+        params.append('Scale', scaleInput.value);
+    }
+
+    fetch('https://seamusmcn-github-io.onrender.com/chain_songs', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/x-www-form-urlencoded',
+        },
+        body: params.toString(),
+    })
+    .then(response => {
+        if (!response.ok) {
+            return response.text().then(err => { throw err; });
+        }
+        return response.text();
+    })
+    .then(data => {
+        document.getElementById('status').innerText = data;
+    })
+    .catch(error => {
+        document.getElementById('status').innerText = `An error occurred: ${error}`;
+        console.error('Error:', error);
+    });
+});
+
+// Handle Spectrum Button Click (catalog from the form above, Master if none picked)
+document.getElementById('spectrum-button').addEventListener('click', function() {
+    const userId = localStorage.getItem('user_id');
+    if (!userId) {
+        document.getElementById('status').innerText = 'Please authenticate first.';
+        return;
+    }
+
+    const checked = document.querySelector('input[name="Catalog"]:checked');
+    const params = new URLSearchParams({
+        'Catalog': checked ? checked.value : 'Master',
+        'user_id': userId,
+        'parameter': document.getElementById('spectrum-parameter').value,
+        'descending': document.getElementById('spectrum-descending').checked ? 'true' : 'false'
+    });
+
+    fetch('https://seamusmcn-github-io.onrender.com/spectrum_playlist', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/x-www-form-urlencoded',
+        },
+        body: params.toString(),
+    })
+    .then(response => {
+        if (!response.ok) {
+            return response.text().then(err => { throw err; });
+        }
+        return response.text();
+    })
+    .then(data => {
+        document.getElementById('status').innerText = data;
+    })
+    .catch(error => {
+        document.getElementById('status').innerText = `An error occurred: ${error}`;
+        console.error('Error:', error);
+    });
+});
+
+// Key playlist buttons, one per key
+['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B'].forEach(key => {
+    const button = document.createElement('button');
+    button.innerText = key;
+    button.className = 'push--skeuo push--red';
+    button.addEventListener('click', function() {
+        const userId = localStorage.getItem('user_id');
+        if (!userId) {
+            document.getElementById('status').innerText = 'Please authenticate first.';
+            return;
+        }
+
+        const checked = document.querySelector('input[name="Catalog"]:checked');
+        const params = new URLSearchParams({
+            'Catalog': checked ? checked.value : 'Master',
+            'user_id': userId,
+            'key': key,
+            'mode': document.querySelector('input[name="KeyMode"]:checked').value,
+            'neighbours': document.getElementById('key-neighbours').checked ? 'true' : 'false'
+        });
+
+        fetch('https://seamusmcn-github-io.onrender.com/key_playlist', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            body: params.toString(),
+        })
+        .then(response => {
+            if (!response.ok) {
+                return response.text().then(err => { throw err; });
+            }
+            return response.text();
+        })
+        .then(data => {
+            document.getElementById('status').innerText = data;
+        })
+        .catch(error => {
+            document.getElementById('status').innerText = `An error occurred: ${error}`;
+            console.error('Error:', error);
+        });
+    });
+    document.getElementById('key-buttons').appendChild(button);
+});
+
+// Handle BOAT Button Click
+document.getElementById('boat-button').addEventListener('click', function() {
+    const userId = localStorage.getItem('user_id');
+    if (!userId) {
+        document.getElementById('status').innerText = 'Please authenticate first.';
+        return;
+    }
+
+    const params = new URLSearchParams({ 'user_id': userId });
+    const seedPlaylist = document.getElementById('boat-seed').value.trim();
+    if (seedPlaylist) {
+        params.append('seed_playlist', seedPlaylist);
+    }
+
+    fetch('https://seamusmcn-github-io.onrender.com/boat_playlist', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/x-www-form-urlencoded',
+        },
+        body: params.toString(),
+    })
+    .then(response => {
+        if (!response.ok) {
+            return response.text().then(err => { throw err; });
+        }
+        return response.text();
+    })
+    .then(data => {
+        document.getElementById('status').innerText = data;
+    })
+    .catch(error => {
+        document.getElementById('status').innerText = `An error occurred: ${error}`;
+        console.error('Error:', error);
+    });
+});
+
+// JSON body if the server sent JSON, otherwise the text as { message } (errors come back as plain text)
+async function readResponse(res) {
+    const type = res.headers.get('Content-Type') || '';
+    if (type.includes('application/json')) {
+        return res.json();
+    }
+    return { message: await res.text() };
+}
+
+// Poll a background job until it's done, showing its progress in the status line
+async function pollJob(jobId, userId) {
+    const status = document.getElementById('status');
+    const url = `https://seamusmcn-github-io.onrender.com/jobs/${encodeURIComponent(jobId)}?user_id=${encodeURIComponent(userId)}`;
+    for (let attempt = 0; attempt < 300; attempt++) {
+        const res = await fetch(url);
+        const job = await readResponse(res);
+        if (!res.ok) {
+            status.innerText = `An error occurred: ${job.message}`;
+            return;
+        }
+        if (job.status === 'done') {
+            status.innerText = job.message;
+            return;
+        }
+        if (job.status === 'failed') {
+            status.innerText = `An error occurred: ${job.error}`;
+            return;
+        }
+        status.innerText = `${job.stage || 'Working'}... ${Math.round(job.progress * 100)}%`;
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+    status.innerText = 'Still working on it, check Spotify in a bit.';
+}
+
+// Response from /artist_playlist: a job to poll, or a message / error to show
+async function handleArtistResponse(res, userId) {
+    const data = await readResponse(res);
+    if (res.status === 202 && data.id) {
+        if (data.coalesced) {
+            document.getElementById('status').innerText = 'Already building that playlist...';
+        }
+        await pollJob(data.id, userId);
+        return null;
+    }
+    if (!res.ok) {
+        document.getElementById('status').innerText = `An error occurred: ${data.message}`;
+        return null;
+    }
+    return data;
+}
+
 // Handle Artist.cat Button Click
 document.getElementById('artist-cat-button')
   .addEventListener('click', async () => {
@@ -130,13 +353,18 @@ document.getElementById('artist-cat-button')
     const old = document.getElementById('artist-options');
     if (old) old.remove();
 
+    const includeCovers = document.getElementById('artist-covers').checked ? 'true' : 'false';
+
     // 1) fetch the list of associated artists
     const res1 = await fetch('https://seamusmcn-github-io.onrender.com/artist_playlist', {
       method: 'POST',
       headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
-      body: new URLSearchParams({ user_id: userId })
+      body: new URLSearchParams({ user_id: userId, include_covers: includeCovers })
     });
-    const data1 = await res1.json();
+    const data1 = await handleArtistResponse(res1, userId);
+    if (!data1) {
+      return;  // error shown, or the playlist was built straight away (no associated artists)
+    }
     const assoc = data1.associated_artists || [];
 
     // 2) build the UI
@@ -196,6 +424,7 @@ document.getElementById('artist-cat-button')
 
       const params = new URLSearchParams();
       params.append('user_id', userId);
+      params.append('include_covers', includeCovers);
       // append each artist separately
         allExtras.forEach(artist => {
             params.append('include_artists', artist);
@@ -207,9 +436,8 @@ document.getElementById('artist-cat-button')
         headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
         body: params.toString()
       });
-      const data2 = await res2.json();
-      document.getElementById('status').innerText = data2.message;
       container.remove();
+      await handleArtistResponse(res2, userId);
     };
 
     container.appendChild(go);
@@ -1,21 +1,31 @@
-from flask import Flask, request, render_template, session, redirect, jsonify
+import time
+# Boot clock, started before the heavy imports so import_seconds covers them
+BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, request, render_template, session, redirect, jsonify, g
 from flask_cors import CORS
-import requests
-import spotipy
 import json
 from uuid import uuid4
 from spotipy.oauth2 import SpotifyOAuth
-import pandas as pd
 import numpy as np
-from astropy.table import Table, vstack, Column
-from io import StringIO
+import threading
 import logging
-import time
-import re
 import os
-import glob
 import sys
 
+from catalog_cache import CatalogCache
+from catalog_store import read_catalog_bytes
+from catalog_indexes import ArtistGraph, key_index, key_label, mode_index, normalize_artist, parameter_name
+from boat import GaussianSampler
+from spotify_session import RequestSpotify, track_uri
+from playlist_sync import sync_playlist
+from feature_store import FeatureStore
+from playlist_index import PlaylistIndexes
+from taste_stats import TasteAnalytics
+from metrics import ROWS_SCANNED, REQUEST_SECONDS, SERVER_TIMING, begin_request, end_request, install_redaction, registry, server_timing, span
+from token_store import REDIRECT_URI, SCOPE, TokenManager, client_credentials
+from jobs import JobQueue, TooManyJobs
+
 """
 List : 5 closest/similar to Song playing
 Chain: 5 closest (for loop), 1st closest to one playing, then 2nd closest to queue,... so on. - might have a bunch of repeats
@@ -52,10 +62,34 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s', 
     stream=sys.stdout  # Ensures logs appear in Render
 )
+# Never let a token, secret or auth code reach the logs (spotipy's debug logging prints request headers)
+install_redaction()
+
+# Logins and pending OAuth states live in SQLite (shared by every worker), tokens get refreshed in the background
+token_manager = TokenManager().start()
+
+# Slow playlist builds run in the background, the page polls /jobs/<id> for progress
+jobs = JobQueue()
+
+# Parsed catalogs (+ feature matrices) shared between requests and workers, compiled catalogs get mapped by warm()
+catalog_cache = CatalogCache()
+
+# Audio features by track id from every catalog csv (spotify took away the audio_features endpoint), loaded by warm()
+feature_store = FeatureStore()
+
+# Documented playlists by spotify playlist id, as masks over the Master catalog (Catalog=Current)
+playlist_indexes = PlaylistIndexes(feature_store)
 
-# Temporary in-memory store for state data
-state_data_store = {}
-user_tokens = {}
+# Histograms / correlations / density grids of each catalog's parameters, updated with just the new rows
+taste_stats = TasteAnalytics(catalog_cache)
+
+# Boot: 'off' (the default) leaves everything to the first request, 'block' warms the catalogs before this worker
+# takes traffic, 'background' warms them in a thread (requests still work, /ready says 503 until it's done).
+# If the warm step fails /ready stays 503 with the reason in warm_error
+WARM_ON_BOOT = os.environ.get('WARM_ON_BOOT', 'off').lower()
+WARM_CATALOGS = [(user_abbrev, name) for user_abbrev in ('S', 'C') for name in ('Master_Catalog', 'Liked_Songs')]
+boot = {'ready': False, 'warm': WARM_ON_BOOT, 'warm_error': None, 'import_seconds': None, 'warm_seconds': None,
+        'first_response_seconds': None}
 
 def authenticate_spotify(client_id, client_secret, redirect_uri, state):
     sp_oauth = SpotifyOAuth(
@@ -63,20 +97,15 @@ def authenticate_spotify(client_id, client_secret, redirect_uri, state):
         client_secret=client_secret,
         redirect_uri=redirect_uri,
         state=state,
-        scope='user-library-read playlist-read-private user-read-currently-playing user-read-playback-state user-modify-playback-state playlist-modify-private playlist-modify-public',
+        scope=SCOPE,
         show_dialog=True
     )
     auth_url = sp_oauth.get_authorize_url()
     return auth_url
 
 def read_csv_with_encoding(response):
-    # Decode the response content with 'utf-8' and replace errors
-    decoded_content = response.content.decode('utf-8', errors='replace')
-    # Use StringIO to create a file-like object from the decoded string
-    csv_data = StringIO(decoded_content)
-    # Read the CSV into a DataFrame
-    df = pd.read_csv(csv_data)
-    return df
+    # Decode the response content with 'utf-8' (replacing errors) and read the CSV into a DataFrame
+    return read_catalog_bytes(response.content)
 
 # Function to get the current playing track
 def get_current_playing_track(sp):
@@ -88,33 +117,28 @@ def get_current_playing_track(sp):
             'artists': [artist['name'] for artist in track_info['artists']],
             'album': track_info['album']['name'],
             'uri': track_info['uri'],
-            'features': sp.audio_features(track_info['id'])[0]  # Get audio features
+            'features': feature_store.audio_features(track_info['id'])  # From our catalogs, None if we don't have it
         }
     return None
 
-def get_current_playlist(sp):
+# ID of the playlist that's playing, straight from the playback snapshot (None if it isn't a playlist)
+def get_current_playlist_id(sp):
     current_playback = sp.current_playback()
 
     if current_playback is None or 'context' not in current_playback or current_playback['context'] is None:
         return None
 
     # Check if the current context is a playlist
-    if 'context' in current_playback and current_playback['context']['type'] == 'playlist':
-        # Get the playlist URI
-        playlist_uri = current_playback['context']['uri']
-
+    if current_playback['context']['type'] == 'playlist':
         # Extract the playlist ID from the URI (format is spotify:playlist:<playlist_id>)
-        playlist_id = playlist_uri.split(':')[-1]
-
-        # Use the playlist ID to get the playlist name (or other details)
-        playlist_info = sp.playlist(playlist_id)
-        playlist_name = playlist_info['name']
-        
-        return playlist_name
+        return current_playback['context']['uri'].split(':')[-1]
     return None
 
 # Add random song from Master Catalog
 def add_song_to_queue(sp):
+    # astropy takes longer to import than the rest of the app, and this is the only thing that uses it
+    from astropy.table import Table
+
     # add random song from Master_Catalog into the queue
     MC = Table.read('Master_Catalog.csv', format='csv')
     random_song = MC[np.random.randint(0, len(MC))]
@@ -122,73 +146,146 @@ def add_song_to_queue(sp):
     sp.add_to_queue(song_uri)
     print(f"Added {song_uri} to queue.")
 
-# Function that adds to queue the most similar song from Master Catalog
-def best_next_songs(sp, MC, n_songs=3):
-
-    # Ensure the columns are sanitized for easier access
-    MC.columns = MC.columns.str.strip()
+# Function that adds to queue the most similar song from a catalog (a CatalogEntry from the catalog cache)
+def best_next_songs(sp, catalog, n_songs=3, scale=None, candidates=None):
 
     # Get the current playback information
     current_track = sp.current_playback()
     if current_track and 'item' in current_track:
         track_info = current_track['item']
         current_track_id = track_info['id']  # Get the current track ID
-        current_features = sp.audio_features(current_track_id)[0]  # Get audio features
-
-        logging.debug(f"Requesting audio features for track ID: {current_track_id}")
-
-        # Convert the current track features into a NumPy array (excluding None values)
-        current_values = np.array([current_features[param] for param in [
-            'danceability', 'energy', 'loudness', 'mode', 'speechiness', 
-            'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo'
-        ] if current_features[param] is not None])
-
-        # Calculate distances to each song in the master catalog
-        distances = []
-        for _, row in MC.iterrows():
-            # Skip if the song is the same as the currently playing song
-            if row['Track ID'] == current_track_id:
-                continue
-
-            # Use a try-except block to ensure the correct column names are used
-            try:
-                features = np.array([row[param] for param in [
-                    'Danceability Rating', 'Energy Rating', 'Loudness Rating', 'Mode Rating', 
-                    'Speechiness Rating', 'Acousticness Rating', 'Instrumentalness Rating', 
-                    'Liveness Rating', 'Valence Rating', 'Tempo Rating'
-                ] if pd.notna(row[param])])
-
-                if len(features) == len(current_values):
-                    # Calculate Euclidean distance
-                    distance = np.linalg.norm(current_values - features)
-                    distances.append((row['Track Name'], row['Track ID'], distance))
-            except KeyError as e:
-                print(f"Error with track {row['Track Name']}: {e}")
-
-        # Sort the distances to get the closest songs and select the top n_songs
-        closest_songs = sorted(distances, key=lambda x: x[2])[:n_songs]
+        # Look the features up in our catalogs, no call to spotify
+        with span('features'):
+            seed = feature_store.seed(current_track_id)
+        if seed is None:
+            logging.debug(f"No audio features for track ID: {current_track_id}")
+            raise ValueError("No audio features for this song yet.")
+
+        # One batched distance computation over the whole catalog instead of a row by row loop
+        engine = catalog.engine
+        with span('distances'):
+            rows, distances = engine.nearest(seed, n=n_songs, exclude_ids=[current_track_id], scale=scale,
+                                             candidates=candidates)
+        ROWS_SCANNED.inc(len(engine), stage='distances')
+
+        closest_songs = [(engine.track_name(i), engine.track_id(i), d) for i, d in zip(rows, distances)]
 
         # Queue the top n_songs
-        for song_name, song_id, _ in closest_songs:
-            # Fetch URI using Track ID if 'uri' column is not in the catalog
-            if 'uri' in MC.columns:
-                song_uri = MC[MC['Track ID'] == song_id]['uri'].values[0]
-            else:
-                # Fetch song URI from Spotify API using the Track ID
-                song_info = sp.track(song_id)
-                song_uri = song_info['uri']
-
-            sp.add_to_queue(song_uri)
-            print(f"Added {song_name} to queue.")
-
-        return closest_songs[0][0] if closest_songs else "No similar song found."
+        with span('queue'):
+            for song_name, song_id, _ in closest_songs:
+                # Build the URI from the Track ID, no need to ask Spotify for it
+                sp.add_to_queue(track_uri(song_id))
+                print(f"Added {song_name} to queue.")
+
+        return closest_songs[0][0] if closest_songs else None
+    raise ValueError("No song currently playing")
     
+# Queue songs in order, all sent back to back at the end over spotipy's kept-alive session
+# (spotify has no multi-track queue endpoint, and the calls can't overlap or the order gets scrambled)
+def queue_songs(sp, track_ids):
+    for track_id in track_ids:
+        sp.add_to_queue(track_uri(track_id))
+
+# Chain: 1st song is the closest to the one playing, 2nd is the closest to the 1st, ... no repeats
+def chain_songs(sp, catalog, n_songs=5, scale=None, candidates=None):
+    current_track = sp.current_playback()
+    if not current_track or not current_track.get('item'):
+        return None
+
+    current_track_id = current_track['item']['id']
+    seed = feature_store.seed(current_track_id)
+    if seed is None:
+        raise ValueError("No audio features for this song yet.")
+
+    engine = catalog.engine
+    rows = engine.chain(seed, k=n_songs, exclude_ids=[current_track_id], scale=scale, candidates=candidates)
+
+    queue_songs(sp, [engine.track_id(i) for i in rows])
+    song_names = [engine.track_name(i) for i in rows]
+    logging.debug(f"Queued chain of {len(song_names)} songs")
+    return song_names
+
 with open('artist_associations.json', 'r') as f:
     artist_associations = json.load(f)
 
+# Associates of associates (of associates...), BFS results are cached per artist
+artist_graph = ArtistGraph(artist_associations)
+
+
+# Spectrum: songs from each of the 10 quantile bins of a parameter, played low to high (or high to low)
+def spectrum_cat(sp, catalog, parameter, per_bin=10, descending=False, candidates=None):
+    rows = catalog.spectrum.spectrum(parameter, per_bin=per_bin, descending=descending, candidates=candidates)
+
+    # the same track can show up on more than one row, keep its first spot
+    track_uris = list(dict.fromkeys(catalog.track_id(i) for i in rows))
+    if not track_uris:
+        return None
+
+    name = parameter_name(parameter)
+    playlist_name = f"{name} .spectrum"
+    direction = 'high to low' if descending else 'low to high'
+    new_playlist, _ = sync_playlist(sp, playlist_name, track_uris, description=f"{name}, {direction}")
+
+    # In order this time, the whole point is the gradient
+    sp.shuffle(state=False)
+    sp.start_playback(context_uri=new_playlist['uri'])
+    print(f"Playing {playlist_name}")
+
+    return playlist_name
+
+# Key playlist: every song in a key (+ harmonic neighbours), straight from the catalog's key index
+def key_cat(sp, catalog, key, mode, neighbours=False, play=True, candidates=None):
+    rows = catalog.keys.playlist(key, mode, neighbours=neighbours)
+    if candidates is not None:
+        rows = rows[candidates[rows]]
+    track_ids = list(dict.fromkeys(catalog.track_id(i) for i in rows))
+    if not track_ids:
+        return None, track_ids
+
+    playlist_name = f"{key_label(key, mode)} .key"
+    if play:
+        description = f"{key_label(key, mode)} + neighbouring keys" if neighbours else key_label(key, mode)
+        new_playlist, _ = sync_playlist(sp, playlist_name, track_ids, description=description, keep_order=False)
+        sp.shuffle(state=True)
+        sp.start_playback(context_uri=new_playlist['uri'])
+        print(f"Playing {playlist_name}")
+    return playlist_name, track_ids
+
+# Seed songs' features, songs without their own ratings borrow the Master catalog's
+def seed_features(seed_catalog, master):
+    features = np.array(seed_catalog.features)
+    for i in np.flatnonzero(~seed_catalog.valid):
+        rows = master.rows_for_id(seed_catalog.track_id(i))
+        rows = rows[master.valid[rows]]
+        if len(rows):
+            features[i] = master.features[rows[0]]
+    return features
+
+# BOAT: sample the master catalog from a gaussian fitted to the seed catalog's songs
+def boat_cat(sp, master, seed_catalog, seed_name, n_songs=50, spread=1.0, seed=None, exclude_seed=False, play=True):
+    sampler = GaussianSampler(seed_features(seed_catalog, master), fallback_std=master.std, spread=spread)
+
+    candidates = master.valid.copy()
+    if exclude_seed:
+        candidates &= ~np.isin(master.track_ids, seed_catalog.track_ids)
+
+    rows = sampler.sample(master.features, n_songs, candidates=candidates, track_ids=master.track_ids, seed=seed)
+    track_ids = [master.track_id(i) for i in rows]
+    if not track_ids:
+        return None, track_ids
+
+    playlist_name = f"{seed_name} .boat"
+    if play:
+        description = f"{len(track_ids)} songs around {seed_name} ({sampler.seed_size} seed songs)"
+        new_playlist, _ = sync_playlist(sp, playlist_name, track_ids, description=description, keep_order=False)
+        sp.shuffle(state=True)
+        sp.start_playback(context_uri=new_playlist['uri'])
+        print(f"Playing {playlist_name}")
+    return playlist_name, track_ids
 
 # makes a playlist from the master catalog based on artist you are listening to and most similar song.
-def artist_cat(sp, MC, artists_to_include, discription = None):
+def artist_cat(sp, catalog, artists_to_include, discription = None, include_covers = False, progress = None):
+    progress = progress or (lambda stage, fraction=None: None)
 
     # Get current playback information
     current_track = sp.current_playback()
@@ -201,49 +298,74 @@ def artist_cat(sp, MC, artists_to_include, discription = None):
 
         # Define playlist name based on the artist
         playlist_name = artists_to_include[0] + ' .cat'
-        user_id = sp.current_user()['id']
 
-        # Check if the playlist already exists
-        playlists = sp.current_user_playlists()['items']
-        existing_playlist = next((pl for pl in playlists if pl['name'] == playlist_name), None)
+        # Songs by the current artist(s), a union of slices from the catalog's artist index
+        progress('Finding songs', 0.1)
+        with span('artist_rows'):
+            rows = catalog.artist_index.mask_for(artists_to_include, len(catalog))
 
-        if existing_playlist:
-            # Delete the existing playlist if it exists
-            sp.user_playlist_unfollow(user=user_id, playlist_id=existing_playlist['id'])
-
-        # Filter Master Catalog for songs by the current artist(s)
-        filtered_catalog = MC[MC['Artist(s)'].apply(lambda x: any(artist in x for artist in artists_to_include))]
+        # Covers of their songs by other artists, one title lookup per song
+        if include_covers:
+            with span('covers'):
+                covers = catalog.titles.same_title(np.flatnonzero(rows), exclude=rows)
+            logging.debug(f"Found {len(covers)} covers")
+            rows[covers] = True
 
         # Remove the current song from the filtered catalog
-        filtered_catalog = filtered_catalog[filtered_catalog['Track ID'] != current_track_id]
-
-        # Create a new Spotify playlist
-        new_playlist = sp.user_playlist_create(user=user_id, name=playlist_name, description=discription, public=True)
+        rows[catalog.rows_for_id(current_track_id)] = False
 
         # Get sorted track URIs (excluding current song)
-        track_uris = filtered_catalog['Track ID'].tolist()
+        track_uris = [catalog.track_id(i) for i in np.flatnonzero(rows)]
 
-        # Add the current song URI at the end of the track URIs
-        current_track_uri = track_info['uri']
-        track_uris.append(current_track_uri)  # Place the current song at the end
+        # Add the current song at the end of the track URIs
+        track_uris.append(current_track_id)  # Place the current song at the end
 
-        # Spotify only allows 100 tracks at a time, so we need to batch them
-        chunk_size = 100
-        track_uri_chunks = [track_uris[i:i + chunk_size] for i in range(0, len(track_uris), chunk_size)]
+        ROWS_SCANNED.inc(len(track_uris), stage='artist_rows')
 
-        # Add sorted songs (including the current song at the end) to the new playlist in chunks
-        for chunk in track_uri_chunks:
-            sp.user_playlist_add_tracks(user=user_id, playlist_id=new_playlist['id'], tracks=chunk)
+        # Sync the playlist to these songs (order doesn't matter, it gets shuffled)
+        progress(f"Syncing {len(track_uris)} songs to {playlist_name}", 0.3)
+        with span('playlist_sync'):
+            new_playlist, _ = sync_playlist(sp, playlist_name, track_uris, description=discription, keep_order=False)
 
         # Turn On shuffle because Spotify took away all the audio features
-        sp.shuffle(state=True)
+        progress('Starting playback', 0.9)
+        with span('start_playback'):
+            sp.shuffle(state=True)
 
-        # Play the new playlist
-        sp.start_playback(context_uri=new_playlist['uri'])
+            # Play the new playlist
+            sp.start_playback(context_uri=new_playlist['uri'])
         print(f"Playing {playlist_name}")
 
         return playlist_name
 
+# Job body for /artist_playlist, runs on the job pool after the request has returned
+def build_artist_playlist(progress, sp, catalog, artists_to_include, discription=None, include_covers=False):
+    try:
+        playlist = artist_cat(sp, catalog, artists_to_include, discription=discription, include_covers=include_covers,
+                              progress=progress)
+    finally:
+        sp.log('/artist_playlist job')
+    if isinstance(playlist, tuple):
+        raise ValueError(playlist[0])
+    return f"Now playing {playlist}"
+
+# Queue an artist playlist build, pressing it again with the same artists + options while it's running gets the
+# same job back
+def start_artist_job(user_id, sp, catalog, artists_to_include, **kwargs):
+    # the job logs this client's spotify calls once it's done, not the request
+    g.pop('spotify', None)
+    # primary artist (it names the playlist), then the associates in any order, then the options
+    associates = sorted({normalize_artist(artist) for artist in artists_to_include[1:]})
+    key = ' + '.join([normalize_artist(artists_to_include[0])] + associates)
+    if kwargs.get('include_covers'):
+        key += ' (covers)'
+    try:
+        job, coalesced = jobs.submit(user_id, 'artist_playlist', key,
+                                     build_artist_playlist, sp, catalog, artists_to_include, **kwargs)
+    except TooManyJobs as e:
+        return str(e), 429
+    return jsonify(dict(job, coalesced=coalesced)), 202
+
 # Route to handle Spotify credentials submission
 @app.route('/submit_credentials', methods=['POST'])
 def submit_credentials():
@@ -259,10 +381,9 @@ def submit_credentials():
         logging.warning("Unknown user attempted to login.")
         return jsonify({"error": "You're not in my system, bozo"}), 400
     
-    client_id = os.environ.get(f'CLIENT_ID_{user_abbrev}')
-    client_secret = os.environ.get(f'SPOTIFY_CLIENT_SECRET_{user_abbrev}')
+    client_id, client_secret = client_credentials(user_abbrev)
 
-    redirect_uri = 'https://seamusmcn-github-io.onrender.com/callback'  # Deployed URL
+    redirect_uri = REDIRECT_URI  # Deployed URL
 
     if not client_id or not client_secret:
         logging.error("Missing credentials, submit credentials function")
@@ -271,13 +392,8 @@ def submit_credentials():
     # Generate a unique state string
     state = str(uuid4())
 
-    # Store client_id associated with this state
-    state_data_store[state] = {
-        'client_id': client_id,
-        'redirect_uri': redirect_uri,
-        'user_abbrev': user_abbrev
-        # You can add a timestamp here to expire old states
-    }
+    # Store client_id associated with this state (forgotten after OAUTH_STATE_TTL seconds)
+    token_manager.put_state(state, client_id, redirect_uri, user_abbrev)
 
     logging.debug(f"Generated state {state} for user: {user_name}, initializing authentication.")
 
@@ -296,20 +412,18 @@ def callback():
 
     logging.debug(f"Callback received with state: {state}")
 
-    if not state or state not in state_data_store:
-        logging.warning("Invalid or missing state parameter, callback function 1")
+    # Retrieve stored data using state (and remove it from the store)
+    state_data = token_manager.pop_state(state) if state else None
+    if not state_data:
+        logging.warning("Invalid, expired or missing state parameter, callback function 1")
         return jsonify({"error": "Invalid or missing state parameter."}), 400
 
-    # Retrieve stored data using state
-    client_id = state_data_store[state]['client_id']
-    redirect_uri = state_data_store[state]['redirect_uri']
-    user_abbrev = state_data_store[state]['user_abbrev']
-
-    # Optionally, remove the state from the store
-    del state_data_store[state]
+    client_id = state_data['client_id']
+    redirect_uri = state_data['redirect_uri']
+    user_abbrev = state_data['user_abbrev']
 
     # Retrieve client_secret from environment variables
-    client_secret = os.environ.get(f'SPOTIFY_CLIENT_SECRET_{user_abbrev}')
+    client_secret = client_credentials(user_abbrev)[1]
     if not client_secret:
         logging.error("Spotify client_secret not set in environment variables, callback function 2.")
         return jsonify({"error": "Server configuration error."}), 500
@@ -319,7 +433,7 @@ def callback():
         client_secret=client_secret,
         redirect_uri=redirect_uri,
         state=state,
-        scope='user-library-read playlist-read-private user-read-currently-playing user-read-playback-state user-modify-playback-state playlist-modify-private playlist-modify-public'
+        scope=SCOPE
     )
 
     if code:
@@ -329,14 +443,9 @@ def callback():
             user_id = str(uuid4())
 
             # Store the access token associated with this user_id
-            user_tokens[user_id] = {
-                'access_token': token_info['access_token'],
-                'refresh_token': token_info['refresh_token'],
-                'expires_at': token_info['expires_at'],
-                'user_abbrev': user_abbrev 
-            }
+            token_manager.save_token(user_id, user_abbrev, token_info)
 
-            logging.debug(f"Refresh Token: {token_info.get('refresh_token', 'NO REFRESH TOKEN')}")
+            logging.debug(f"Got a refresh token: {'yes' if token_info.get('refresh_token') else 'NO'}")
 
             logging.debug("Spotify authentication successful, callback.")
             # Log token details to check for missing scopes
@@ -372,85 +481,222 @@ def ensure_token():
     return token_info['access_token']
 
 
+# Spotify client for a logged in user (tokens are kept fresh in the background), (None, None) if not authenticated
+def user_spotify(user_id):
+    sp, user_abbrev = token_manager.client(user_id)
+    if sp is None:
+        return None, None
+
+    # Wrapped so repeat lookups in this request are free
+    g.spotify = RequestSpotify(sp)
+    return g.spotify, user_abbrev
+
+# Catalog picked on the buttons page (Liked / Master / Current), returns (catalog, candidates, None) or
+# (None, None, error response). candidates is a row mask for Current (the playing playlist's songs in Master), else None
+def load_catalog(sp, user_abbrev, Catalog):
+    logging.debug(f"Fetching {Catalog} Catalog")
+
+    # Read the catalog (cached between requests, only refetched when it changes on github)
+    if Catalog == 'Liked':
+        logging.debug("Using Liked Songs catalog.")
+        catalog = catalog_cache.get(user_abbrev, 'Liked_Songs')
+    elif Catalog == 'Master':
+        logging.debug("Using Master catalog.")
+        catalog = catalog_cache.get(user_abbrev, 'Master_Catalog')
+    elif Catalog == 'Current':
+        # The playing playlist's songs as a mask over Master, no csv to fetch (see playlist_index.py)
+        playlist_id = get_current_playlist_id(sp)
+        if not playlist_id:
+            return None, None, ("No playlist found", 404)
+
+        catalog = catalog_cache.get(user_abbrev, 'Master_Catalog')
+        if catalog is None:
+            return None, None, ("Failed to fetch Master catalog.", 500)
+        playing = (sp.current_playback() or {}).get('item')
+        seed = feature_store.seed(playing['id']) if playing else None
+        try:
+            resolved = playlist_indexes.resolve(sp, user_abbrev, catalog, playlist_id, seed=seed)
+        except Exception as e:
+            logging.error(f"Error looking up current playlist: {str(e)}, load catalog")
+            return None, None, (f"Error looking up current playlist: {str(e)}", 500)
+        if resolved is None:
+            return None, None, ("Playlist not documented, Master instead.", 404)
+
+        # undocumented playlists borrow the documented playlist nearest to them
+        index, p, how = resolved
+        logging.debug(f"Current playlist -> {index.names[p]} ({how})")
+        return catalog, index.mask(p), None
+    else:
+        return None, None, ("Unknown catalog.", 400)
+
+    if catalog is None:
+        return None, None, (f"Failed to fetch {Catalog} catalog.", 500)
+    return catalog, None, None
+
+
 @app.route('/most_similar_song', methods=['POST'])
 def most_similar_song():
     # Get user_id from the request
     user_id = request.form.get('user_id')
     logging.debug(f"Received request to queue most similar song for user {user_id}")
 
-    if not user_id or user_id not in user_tokens:
+    with span('auth'):
+        sp, user_abbrev = user_spotify(user_id)
+    if sp is None:
         logging.warning(f"Unauthorized request for most_similar_song. User ID: {user_id}")
         return "User not authenticated. Please authenticate first.", 401
 
-    # Retrieve the access token
-    token_info = user_tokens[user_id]
-    access_token = token_info['access_token']
-    user_abbrev = token_info['user_abbrev']
+    # Fetch catalog data and find the best next song
+    with span('catalog'):
+        catalog, candidates, error = load_catalog(sp, user_abbrev, request.form.get('Catalog'))
+    if error:
+        return error
+
+    # Optional per-feature scaling ('standard' so tempo/loudness don't dominate)
+    scale = request.form.get('Scale') or None
+    try:
+        song_name = best_next_songs(sp, catalog, scale=scale, candidates=candidates)
+    except ValueError as e:
+        return str(e), 400
+    if song_name is None:
+        return "No similar song found.", 404
 
-    logging.debug(f"User info: {token_info}")
+    logging.debug(f"Added {song_name} to queue for user {user_id}")
 
-    # Optionally refresh the token if expired
-    if time.time() > token_info['expires_at']:
-        logging.debug(f"Refreshing token for user: {user_id}")
-        client_id = os.environ.get(f'SPOTIFY_CLIENT_ID_{user_abbrev}')
-        client_secret = os.environ.get(f'SPOTIFY_CLIENT_SECRET_{user_abbrev}')
-        
-        sp_oauth = SpotifyOAuth(client_id=client_id, client_secret=client_secret, redirect_uri='https://seamusmcn-github-io.onrender.com/callback')
-        
-        new_token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-        
-        # Store the refreshed token properly
-        user_tokens[user_id] = {
-            'access_token': new_token_info['access_token'],
-            'refresh_token': new_token_info['refresh_token'],
-            'expires_at': new_token_info['expires_at'],
-            'user_abbrev': user_abbrev
-        }
-        
-        access_token = new_token_info['access_token']
-        logging.debug(f"New token stored for user: {user_id}")
-        logging.debug(f"Using access token: {access_token}")
+    return f"Added {song_name} to queue."
 
-    # Use the access token to authenticate Spotify requests
-    sp = spotipy.Spotify(auth=access_token)
 
-    # Fetch catalog data and find the best next song
-    Catalog = request.form.get('Catalog')
-    logging.debug(f"Fetching {Catalog} Catalog")
+@app.route('/chain_songs', methods=['POST'])
+def queue_chain():
+    user_id = request.form.get('user_id')
+    logging.debug(f"Received request to queue a chain for user {user_id}")
 
-        # Read the master catalog
-    if Catalog == 'Liked':
-        logging.debug("Using Liked Songs catalog.")
-        MC = read_csv_with_encoding(requests.get(f'https://raw.githubusercontent.com/seamusmcn/seamusmcn.github.io/main/{user_abbrev}_playlists/Liked_Songs.csv'))
-    elif Catalog == 'Master':
-        logging.debug("Using Master catalog.")
-        MC = read_csv_with_encoding(requests.get(f'https://raw.githubusercontent.com/seamusmcn/seamusmcn.github.io/main/{user_abbrev}_playlists/Master_Catalog.csv'))
-    elif Catalog == 'Current':
-        # Get the currently playing playlist
-        current_playlist = get_current_playlist(sp)
-        
-        if current_playlist:
-            # Try to fetch the playlist CSV
-            try:
-                response_current = requests.get(f'https://raw.githubusercontent.com/seamusmcn/seamusmcn.github.io/main/{user_abbrev}_playlists/{current_playlist}.csv')
-                if response_current.status_code == 200:
-                    MC = read_csv_with_encoding(response_current)
-                else:
-                    # If the playlist is not documented, use the master catalog
-                    MC = read_csv_with_encoding(requests.get(f'https://raw.githubusercontent.com/seamusmcn/seamusmcn.github.io/main/{user_abbrev}_playlists/Master_Catalog.csv'))
-                    return "Playlist not documented, Master instead.", 404
-
-            except Exception as e:
-                logging.error(f"Error fetching current playlist: {str(e)}, most similar song")
-                return f"Error fetching current playlist: {str(e)}", 500
-        else:
-            return "No playlist found", 404
+    sp, user_abbrev = user_spotify(user_id)
+    if sp is None:
+        logging.warning(f"Unauthorized request for chain_songs. User ID: {user_id}")
+        return "User not authenticated. Please authenticate first.", 401
 
-    song_name = best_next_songs(sp, MC)
+    catalog, candidates, error = load_catalog(sp, user_abbrev, request.form.get('Catalog'))
+    if error:
+        return error
 
-    logging.debug(f"Added {song_name} to queue for user {user_id}")
+    try:
+        n_songs = min(max(int(request.form.get('n_songs', 5)), 1), 50)
+    except ValueError:
+        return "n_songs must be a number.", 400
 
-    return f"Added {song_name} to queue."
+    scale = request.form.get('Scale') or None
+    try:
+        song_names = chain_songs(sp, catalog, n_songs=n_songs, scale=scale, candidates=candidates)
+    except ValueError as e:
+        return str(e), 400
+
+    if song_names is None:
+        return "No song currently playing", 400
+    if not song_names:
+        return "No similar song found.", 404
+    return f"Queued {len(song_names)} songs: {', '.join(song_names)}"
+
+
+@app.route('/spectrum_playlist', methods=['POST'])
+def make_spectrum_playlist():
+    user_id = request.form.get('user_id')
+
+    sp, user_abbrev = user_spotify(user_id)
+    if sp is None:
+        return "User not authenticated. Please authenticate first.", 401
+
+    catalog, candidates, error = load_catalog(sp, user_abbrev, request.form.get('Catalog', 'Master'))
+    if error:
+        return error
+
+    try:
+        per_bin = min(max(int(request.form.get('per_bin', 10)), 1), 100)
+    except ValueError:
+        return "per_bin must be a number.", 400
+    descending = request.form.get('descending') == 'true'
+
+    try:
+        playlist = spectrum_cat(sp, catalog, request.form.get('parameter', ''), per_bin=per_bin, descending=descending,
+                                candidates=candidates)
+    except ValueError as e:
+        return str(e), 400
+
+    if playlist is None:
+        return "No songs with that parameter in this catalog.", 404
+    return f"Now playing {playlist}", 200
+
+
+@app.route('/key_playlist', methods=['POST'])
+def make_key_playlist():
+    user_id = request.form.get('user_id')
+
+    sp, user_abbrev = user_spotify(user_id)
+    if sp is None:
+        return "User not authenticated. Please authenticate first.", 401
+
+    try:
+        key = key_index(request.form.get('key', ''))
+        mode = mode_index(request.form.get('mode', 'major'))
+    except ValueError as e:
+        return str(e), 400
+
+    catalog, candidates, error = load_catalog(sp, user_abbrev, request.form.get('Catalog', 'Master'))
+    if error:
+        return error
+
+    neighbours = request.form.get('neighbours') == 'true'
+    play = request.form.get('play', 'true') == 'true'
+    playlist, track_ids = key_cat(sp, catalog, key, mode, neighbours=neighbours, play=play, candidates=candidates)
+
+    if playlist is None:
+        return f"No songs in {key_label(key, mode)} in this catalog.", 404
+    if not play:
+        return jsonify({'playlist': playlist, 'track_ids': track_ids}), 200
+    return f"Now playing {playlist}", 200
+
+
+@app.route('/boat_playlist', methods=['POST'])
+def make_boat_playlist():
+    user_id = request.form.get('user_id')
+
+    sp, user_abbrev = user_spotify(user_id)
+    if sp is None:
+        return "User not authenticated. Please authenticate first.", 401
+
+    try:
+        n_songs = min(max(int(request.form.get('n_songs', 50)), 1), 500)
+        spread = float(request.form.get('spread', 1.0))
+        seed = int(request.form['seed']) if request.form.get('seed') else None
+    except ValueError:
+        return "n_songs, spread and seed must be numbers.", 400
+    if spread <= 0:
+        return "spread must be positive.", 400
+
+    # Seed set: the liked songs by default, or any documented playlist csv
+    seed_name = request.form.get('seed_playlist') or 'Liked_Songs'
+    if seed_name not in catalog_cache.documented(user_abbrev):
+        return f"Playlist {seed_name} not documented.", 404
+    seed_catalog = catalog_cache.get(user_abbrev, seed_name)
+    if seed_catalog is None:
+        return f"Playlist {seed_name} not documented.", 404
+    master = catalog_cache.get(user_abbrev, 'Master_Catalog')
+    if master is None:
+        return "Failed to fetch Master Catalog.", 500
+
+    exclude_seed = request.form.get('exclude_seed') == 'true'
+    play = request.form.get('play', 'true') == 'true'
+    try:
+        playlist, track_ids = boat_cat(sp, master, seed_catalog, seed_name, n_songs=n_songs, spread=spread,
+                                       seed=seed, exclude_seed=exclude_seed, play=play)
+    except ValueError as e:
+        return str(e), 400
+
+    if playlist is None:
+        return "No songs found around that seed.", 404
+    if not play:
+        return jsonify({'playlist': playlist, 'track_ids': track_ids}), 200
+    return f"Now playing {playlist}", 200
 
 
 @app.route('/artist_playlist', methods=['POST'])
@@ -459,65 +705,43 @@ def make_artist_playlist():
         # Get user_id from the request
         user_id = request.form.get('user_id')
 
-        if not user_id or user_id not in user_tokens:
+        with span('auth'):
+            sp, user_abbrev = user_spotify(user_id)
+        if sp is None:
             return "User not authenticated. Please authenticate first.", 401
 
-        # Retrieve the access token
-        token_info = user_tokens[user_id]
-        access_token = token_info['access_token']
-        user_abbrev = token_info['user_abbrev']
-
-        # Optionally refresh the token if expired
-        if time.time() > token_info['expires_at']:
-            logging.debug(f"Refreshing token for user: {user_id}")
-            client_id = os.environ.get(f'SPOTIFY_CLIENT_ID_{user_abbrev}')
-            client_secret = os.environ.get(f'SPOTIFY_CLIENT_SECRET_{user_abbrev}')
-            
-            sp_oauth = SpotifyOAuth(client_id=client_id, client_secret=client_secret, redirect_uri='https://seamusmcn-github-io.onrender.com/callback')
-            
-            new_token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-            
-            # Store the refreshed token properly
-            user_tokens[user_id] = {
-                'access_token': new_token_info['access_token'],
-                'refresh_token': new_token_info['refresh_token'],
-                'expires_at': new_token_info['expires_at'],
-                'user_abbrev': user_abbrev
-            }
-            
-            access_token = new_token_info['access_token']
-            logging.debug(f"New token stored for user: {user_id}")
-
-
-        # Use the access token to authenticate Spotify requests
-        sp = spotipy.Spotify(auth=access_token)
-
-        response_master = requests.get(f'https://raw.githubusercontent.com/seamusmcn/seamusmcn.github.io/main/{user_abbrev}_playlists/Master_Catalog.csv')
-        if response_master.status_code != 200:
+        with span('catalog'):
+            master = catalog_cache.get(user_abbrev, 'Master_Catalog')
+        if master is None:
             return "Failed to fetch Master Catalog.", 500
-        
-        MC = read_csv_with_encoding(response_master)
-        
+
         logging.debug("Read master Catalog")
 
-        track = sp.current_playback().get('item', {})
+        # same playback snapshot artist_cat uses, so this costs one call between them
+        with span('playback'):
+            track = (sp.current_playback() or {}).get('item')
         if not track:
             return "No song playing.", 400
         primary_artist = track['artists'][0]['name']
 
         include = request.form.getlist('include_artists')
+        include_covers = request.form.get('include_covers') == 'true'
         if include:
             desc = f"+ {', '.join(include)}"
-            playlist = artist_cat(sp, MC, [primary_artist] + include, discription=desc)
-            return f"Now playing {playlist}", 200
+            return start_artist_job(user_id, sp, master, [primary_artist] + include, discription=desc,
+                                    include_covers=include_covers)
         
-        assoc = artist_associations.get(primary_artist, [])
+        try:
+            depth = min(max(int(request.form.get('depth', 1)), 1), 5)
+        except ValueError:
+            depth = 1
+        with span('artist_graph'):
+            assoc = artist_graph.related(primary_artist, depth)
         if assoc:
             return jsonify({ 'associated_artists': assoc }), 200
         else:
             # no associates defined → just build immediately
-            playlist = artist_cat(sp, MC, [primary_artist])
-            return f"Now playing {playlist}", 200
+            return start_artist_job(user_id, sp, master, [primary_artist], include_covers=include_covers)
         
     except Exception as e:
         logging.error(f"Error in make_artist_playlist: {e}")
@@ -527,5 +751,133 @@ def make_artist_playlist():
         logging.error(f"Exception Error fetching playback info: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # Status + progress of a background job, only for the user who started it
+    job = jobs.get(job_id, user_id=request.args.get('user_id') or '')
+    if job is None:
+        return "No such job.", 404
+    return jsonify(job), 200
+
+@app.route('/taste_stats', methods=['GET'])
+def get_taste_stats():
+    # Parameter histograms, correlation matrix and 2-D densities of a catalog for the scatter plots,
+    # ?catalog=Liked_Songs (default) / Master_Catalog / a playlist, ?features=Energy,Valence for just those
+    token = token_manager.get_token(request.args.get('user_id') or '')
+    if token is None:
+        return "User not authenticated. Please authenticate first.", 401
+    features = [f for f in request.args.get('features', '').split(',') if f.strip()]
+    name = request.args.get('catalog') or 'Liked_Songs'
+    if name not in catalog_cache.documented(token['user_abbrev']):
+        return "Catalog not documented.", 404
+    try:
+        stats = taste_stats.get(token['user_abbrev'], name)
+        if stats is None:
+            return "Catalog not documented.", 404
+        return jsonify(stats.to_json(features or None)), 200
+    except ValueError as e:
+        return str(e), 400
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    begin_request()
+
+@app.after_request
+def log_spotify_calls(response):
+    # How many Spotify round trips this request actually made
+    spotify = g.pop('spotify', None)
+    if spotify is not None:
+        spotify.log(request.path)
+
+    # health checks and scrapes don't count as the first response
+    if boot['first_response_seconds'] is None and request.endpoint not in ('ready', 'metrics', None):
+        boot['first_response_seconds'] = round(time.perf_counter() - BOOT_STARTED, 3)
+        logging.info(f"First response {boot['first_response_seconds']}s after boot")
+
+    # Request latency + where it went (Server-Timing shows up in the browser's network tab)
+    spans = end_request()
+    if 'request_start' in g:
+        elapsed = time.perf_counter() - g.pop('request_start')
+        REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint or 'unknown', status=response.status_code)
+        if SERVER_TIMING or request.args.get('timing') == '1':
+            response.headers['Server-Timing'] = server_timing(spans + [('total', elapsed)])
+    return response
+
+@app.route('/catalog_cache_stats', methods=['GET'])
+def catalog_cache_stats():
+    # Hit/miss counters for the catalog cache (seconds_saved = fetch + parse time skipped by hits)
+    return jsonify(catalog_cache.stats()), 200
+
+# Counts the caches already keep, read when /metrics is scraped
+registry.collect(lambda: {f"catalog_cache_{k}_total": v for k, v in catalog_cache.stats().items()
+                          if k in ('hits', 'misses', 'revalidated', 'refreshed', 'fallbacks', 'evictions')},
+                 kind='counter', help='Catalog cache counter')
+registry.collect(lambda: {f"catalog_cache_{k}": v for k, v in catalog_cache.stats().items() if k in ('entries', 'bytes')},
+                 help='Catalog cache size')
+registry.collect(lambda: {f"feature_store_{k}_total": v for k, v in feature_store.stats().items() if k in ('hits', 'misses')},
+                 kind='counter', help='Feature store lookups')
+registry.collect(lambda: {f"taste_stats_{k}_total": v for k, v in taste_stats.stats().items()
+                          if k in ('hits', 'current', 'appended', 'updated', 'built')},
+                 kind='counter', help='Taste stats lookups, by how much had to be counted')
+registry.collect(lambda: {'logged_in_users': token_manager.stats()['users']}, help='Stored Spotify logins')
+registry.collect(lambda: {k: v for k, v in jobs.stats().items() if k.startswith('jobs_')}, help='Background jobs by status')
+registry.collect(lambda: {f"boot_{k}": v for k, v in boot.items() if v is not None and k != 'warm'},
+                 help='Boot timings (seconds) and readiness')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format, per worker
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    # Readiness check for the load balancer: 503 until the boot warm step is done, and for good if it failed
+    return jsonify(boot), 200 if boot['ready'] else 503
+
+# Map the compiled catalogs, fetch + index (+ count the taste stats of) the ones every button needs, load the feature
+# store and index the playlists
+def warm():
+    start = time.perf_counter()
+    errors = []
+    try:
+        with span('warm'):
+            catalog_cache.preload()
+            for user_abbrev, name in WARM_CATALOGS:
+                try:
+                    catalog_cache.get(user_abbrev, name)
+                    taste_stats.get(user_abbrev, name)
+                except Exception as e:
+                    logging.warning(f"Couldn't warm {user_abbrev}/{name}: {e}")
+                    errors.append(f"{user_abbrev}/{name}: {e}")
+            feature_store.load()
+            for user_abbrev in ('S', 'C'):
+                try:
+                    master = catalog_cache.get(user_abbrev, 'Master_Catalog')
+                    if master is not None:
+                        playlist_indexes.get(user_abbrev, master)
+                except Exception as e:
+                    logging.warning(f"Couldn't index the {user_abbrev} playlists: {e}")
+                    errors.append(f"{user_abbrev} playlists: {e}")
+    except Exception as e:
+        logging.error(f"Warm step failed: {e}")
+        errors.append(str(e))
+    boot['warm_seconds'] = round(time.perf_counter() - start, 3)
+    if errors:
+        # the worker still answers requests (they load what they need), it just doesn't claim to be warm
+        boot['warm_error'] = '; '.join(errors)
+        logging.error(f"Warm failed after {boot['warm_seconds']}s, /ready stays 503")
+    else:
+        boot['ready'] = True
+        logging.info(f"Warm in {boot['warm_seconds']}s")
+
+boot['import_seconds'] = round(time.perf_counter() - BOOT_STARTED, 3)
+if WARM_ON_BOOT == 'block':
+    warm()
+elif WARM_ON_BOOT == 'background':
+    threading.Thread(target=warm, name='warm', daemon=True).start()
+else:
+    boot['ready'] = True
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,477 @@
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+import pandas as pd
+
+"""
+Benchmarks for the similarity / artist buttons that don't need spotify or github.
+
+    python benchmark.py                                   # 6k, 100k and 1M row catalogs
+    python benchmark.py --sizes 6000 --spotify-latency 30 --catalog-latency 80
+    python benchmark.py --compare bench_results/abc1234.json
+
+Every size runs in its own process so peak memory means something. That process starts a stand-in spotify
+web api (enough of it for the routes: playback, queue, playlists) and a file server for the catalog csvs
+(with ETags, so the catalog cache behaves like it does against github), both with configurable latency, points
+app.py at them through the environment, and drives the Flask app with its test client.
+Synthetic catalogs use Master_Catalog.csv's columns, with a long tail of artists, repeated titles (covers)
+and a few rows of -99s, and are cached in bench_data/.
+
+For each endpoint and core function it reports latency percentiles, throughput, peak python allocations
+(tracemalloc, on a separate pass so it doesn't skew the timings) and how many spotify calls one run makes,
+plus import time and time to first response (import + the first /most_similar_song) for each --warm mode.
+Results go to bench_results/<commit>.json, --compare prints the p50 change against an older file.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_DATA = os.path.join(HERE, 'bench_data')
+BENCH_RESULTS = os.path.join(HERE, 'bench_results')
+DEFAULT_SIZES = [6000, 100000, 1000000]
+
+BASE62 = np.frombuffer(b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz', dtype='S1')
+WORDS = ['Love', 'Moon', 'Blue', 'Night', 'Dream', 'Heart', 'River', 'Summer', 'Baby', 'Fire', 'Rain', 'Road',
+         'Song', 'Time', 'Dance', 'Light', 'Home', 'Gold', 'Wild', 'Lonely', 'Sweet', 'Train', 'Angel', 'Sky']
+
+
+# A catalog with Master_Catalog.csv's columns and roughly its shape
+def synthetic_catalog(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+
+    track_ids = BASE62[rng.integers(0, 62, size=(n_rows, 22))].view('S22').ravel().astype(str)
+
+    # a long tail of artists (a few with hundreds of songs), 1 in 10 songs has a featured artist
+    n_artists = max(n_rows // 25, 10)
+    popularity = 1.0 / np.arange(1, n_artists + 1) ** 0.8
+    artist_codes = rng.choice(n_artists, size=n_rows, p=popularity / popularity.sum())
+    artists = np.char.add('Artist ', artist_codes.astype(str))
+    featured = rng.random(n_rows) < 0.1
+    artists[featured] = np.char.add(np.char.add(artists[featured], ', Artist '),
+                                    rng.integers(0, n_artists, featured.sum()).astype(str))
+
+    # titles come from a smaller pool than tracks, so plenty of them are recorded by more than one artist
+    n_titles = max(n_rows // 3, 10)
+    title_words = np.array(WORDS)[rng.integers(0, len(WORDS), size=(n_titles, 2))]
+    titles = np.char.add(np.char.add(np.char.add(title_words[:, 0], ' '), title_words[:, 1]),
+                         np.char.add(' ', np.arange(n_titles).astype(str)))
+    track_names = titles[rng.integers(0, n_titles, n_rows)]
+    albums = np.char.add(artists, np.char.add(' Album ', rng.integers(0, 8, n_rows).astype(str)))
+
+    frame = pd.DataFrame({
+        'Track ID': track_ids,
+        'Track Name': track_names,
+        'Artist(s)': artists,
+        'Album': albums,
+        'Danceability Rating': rng.beta(5, 4, n_rows).round(3),
+        'Energy Rating': rng.beta(3, 3, n_rows).round(3),
+        'Key Rating': rng.integers(0, 12, n_rows),
+        'Loudness Rating': np.clip(rng.normal(-9, 4, n_rows), -40, 0).round(3),
+        'Mode Rating': (rng.random(n_rows) < 0.65).astype(int),
+        'Speechiness Rating': rng.gamma(1.5, 0.04, n_rows).clip(0, 1).round(4),
+        'Acousticness Rating': rng.beta(1, 2, n_rows).round(4),
+        'Instrumentalness Rating': (rng.beta(0.3, 3, n_rows) * (rng.random(n_rows) < 0.4)).round(6),
+        'Liveness Rating': rng.gamma(2, 0.09, n_rows).clip(0, 1).round(4),
+        'Valence Rating': rng.beta(3, 3, n_rows).round(3),
+        'Tempo Rating': np.clip(rng.normal(120, 28, n_rows), 50, 220).round(3),
+    })
+    # a few songs spotify never gave us ratings for
+    missing = rng.random(n_rows) < 0.03
+    frame.loc[missing, frame.columns[4:]] = -99
+    return frame
+
+
+# bench_data/<n_rows>/S_playlists/ with Master_Catalog.csv and a Liked_Songs.csv sample, made once per size + seed
+def catalog_dir(n_rows, seed=0):
+    root = os.path.join(BENCH_DATA, f"{n_rows}_{seed}")
+    folder = os.path.join(root, 'S_playlists')
+    if not os.path.exists(os.path.join(folder, 'Master_Catalog.csv')):
+        os.makedirs(folder, exist_ok=True)
+        frame = synthetic_catalog(n_rows, seed)
+        frame.sample(n=min(n_rows, 2000), random_state=seed).to_csv(os.path.join(folder, 'Liked_Songs.csv'), index=False)
+        tmp_path = os.path.join(folder, 'Master_Catalog.csv.tmp')
+        frame.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(folder, 'Master_Catalog.csv'))
+    return root
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as two writes, with Nagle on every keep-alive call waits for a delayed ack
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None and not isinstance(body, bytes):
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# Serves files under root, with ETags and 304s like raw.githubusercontent.com
+class CatalogFileHandler(_QuietHandler):
+    root = '.'
+    bytes_sent = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        parts = [unquote(p) for p in urlparse(self.path).path.split('/')]
+        path = os.path.join(self.root, *[p for p in parts if p not in ('', '..')])
+        if not os.path.isfile(path):
+            return self._send(404, b'')
+        stat = os.stat(path)
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, None, {'ETag': etag})
+        with open(path, 'rb') as f:
+            data = f.read()
+        type(self).bytes_sent += len(data)
+        self._send(200, data, {'ETag': etag, 'Content-Type': 'text/plain'})
+
+
+# Just enough of the spotify web api for the routes, playlists are kept in memory so syncs are real diffs
+class FakeSpotifyHandler(_QuietHandler):
+    state = None
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def _route(self, method):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        path = url.path[len('/v1/'):].rstrip('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._body() if method in ('POST', 'PUT', 'DELETE') else None
+        state = self.state
+        with state['lock']:
+            state['calls'] += 1
+            status, response = self._handle(method, path, query, body, state)
+        self._send(status, response)
+
+    def _handle(self, method, path, query, body, state):
+        playlists = state['playlists']
+        if path == 'me':
+            return 200, {'id': state['user_id']}
+        if path == 'me/player':
+            return 200, state['playback']
+        if path in ('me/player/queue', 'me/player/shuffle', 'me/player/play'):
+            return 204, None
+        if path == 'me/playlists':
+            offset, limit = int(query.get('offset', 0)), int(query.get('limit', 50))
+            items = [p['meta'] for p in playlists.values()][offset:offset + limit]
+            return 200, {'items': items, 'next': 'more' if offset + limit < len(playlists) else None}
+        match = re.fullmatch(r'users/([^/]+)/playlists', path)
+        if match and method == 'POST':
+            playlist_id = f"bench{len(playlists)}"
+            meta = {'id': playlist_id, 'name': body['name'], 'description': body.get('description'),
+                    'owner': {'id': match.group(1)}, 'uri': f"spotify:playlist:{playlist_id}"}
+            playlists[playlist_id] = {'meta': meta, 'tracks': []}
+            return 201, meta
+        match = re.fullmatch(r'playlists/([^/]+)(/tracks|/items)?', path)
+        if not match or match.group(1) not in playlists:
+            return 404, {'error': {'status': 404, 'message': f"no fake for {method} {path}"}}
+        playlist = playlists[match.group(1)]
+        if not match.group(2):
+            if method == 'PUT':
+                playlist['meta'].update(body or {})
+                return 200, None
+            return 200, playlist['meta']
+        tracks = playlist['tracks']
+        if method == 'GET':
+            offset, limit = int(query.get('offset', 0)), int(query.get('limit', 100))
+            items = [{'track': {'id': t}} for t in tracks[offset:offset + limit]]
+            return 200, {'items': items, 'next': 'more' if offset + limit < len(tracks) else None}
+        if method == 'POST':
+            uris = body if isinstance(body, list) else body['uris']
+            ids = [u.rsplit(':', 1)[-1] for u in uris]
+            position = query.get('position')
+            if position is None:
+                tracks.extend(ids)
+            else:
+                tracks[int(position):int(position)] = ids
+            return 201, {'snapshot_id': 'bench'}
+        if method == 'DELETE':
+            gone = {item['uri'].rsplit(':', 1)[-1] for item in body.get('items', body.get('tracks', []))}
+            tracks[:] = [t for t in tracks if t not in gone]
+            return 200, {'snapshot_id': 'bench'}
+        if 'uris' in body:
+            tracks[:] = [u.rsplit(':', 1)[-1] for u in body['uris']]
+        else:
+            start, length = body['range_start'], body.get('range_length', 1)
+            moving = tracks[start:start + length]
+            before = body['insert_before']
+            del tracks[start:start + length]
+            at = before if before < start else before - length
+            tracks[at:at] = moving
+        return 200, {'snapshot_id': 'bench'}
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def summarize(latencies, wall_seconds):
+    ms = np.array(latencies) * 1000
+    return {
+        'runs': len(ms),
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p90_ms': round(float(np.percentile(ms, 90)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'mean_ms': round(float(ms.mean()), 3),
+        'min_ms': round(float(ms.min()), 3),
+        'max_ms': round(float(ms.max()), 3),
+        'throughput_per_s': round(len(ms) / wall_seconds, 2) if wall_seconds else None,
+    }
+
+
+# Time fn: warmup runs, then up to iterations runs (stopping early after max_seconds), then a few traced runs for memory
+def measure(fn, iterations, warmup, max_seconds, spotify_state):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    calls_before = spotify_state['calls']
+    wall_start = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+        if time.perf_counter() - wall_start > max_seconds and len(latencies) >= 5:
+            break
+    wall = time.perf_counter() - wall_start
+    result = summarize(latencies, wall)
+    result['spotify_calls_per_run'] = round((spotify_state['calls'] - calls_before) / len(latencies), 2)
+
+    tracemalloc.start()
+    try:
+        for _ in range(min(3, len(latencies))):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            fn()
+            result['peak_alloc_mb'] = max(result.get('peak_alloc_mb', 0),
+                                          round((tracemalloc.get_traced_memory()[1] - baseline) / 1e6, 2))
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+# Everything for one catalog size, run in its own process (see main)
+def run_size(n_rows, args):
+    root = catalog_dir(n_rows, args.seed)
+    master = pd.read_csv(os.path.join(root, 'S_playlists', 'Master_Catalog.csv'), usecols=['Track ID', 'Track Name', 'Artist(s)', 'Album'])
+
+    # play a song whose artist has around 100 songs, so artist playlists look like real ones
+    primary = master['Artist(s)'].str.split(',').str[0]
+    counts = primary.value_counts()
+    artist = (counts - 100).abs().idxmin()
+    row = master[primary == artist].iloc[0]
+
+    spotify_state = {
+        'lock': threading.Lock(), 'calls': 0, 'user_id': 'bench', 'playlists': {},
+        'playback': {
+            'is_playing': True,
+            'context': {'type': 'playlist', 'uri': 'spotify:playlist:benchcontext'},
+            'item': {'id': row['Track ID'], 'uri': f"spotify:track:{row['Track ID']}", 'name': row['Track Name'],
+                     'artists': [{'name': artist}], 'album': {'name': row['Album']}},
+        },
+    }
+    FakeSpotifyHandler.state = spotify_state
+    FakeSpotifyHandler.latency = args.spotify_latency / 1000
+    CatalogFileHandler.root = root
+    CatalogFileHandler.latency = args.catalog_latency / 1000
+    spotify_server, spotify_url = serve(FakeSpotifyHandler)
+    catalog_server, catalog_url = serve(CatalogFileHandler)
+
+    scratch = tempfile.mkdtemp(prefix='bench_')
+    os.environ.update({
+        'SPOTIFY_API_PREFIX': f"{spotify_url}/v1/",
+        'CATALOG_BASE_URL': catalog_url,
+        'LOCAL_CATALOG_DIR': root,
+        'CATALOG_COMPILED_DIR': os.path.join(scratch, 'compiled'),
+        'TOKEN_DB': os.path.join(scratch, 'tokens.db'),
+        'JOB_DB': os.path.join(scratch, 'jobs.db'),
+        'FEATURE_MISS_QUEUE': os.path.join(scratch, 'feature_misses.txt'),
+        'SPOTIFY_RATE_LIMIT': str(args.rate_limit),
+        'CATALOG_CACHE_MAX_MB': '4096',
+        'WARM_ON_BOOT': args.warm,
+    })
+    import logging
+    import_start = time.perf_counter()
+    import app
+    import_seconds = time.perf_counter() - import_start
+    logging.getLogger().setLevel(logging.WARNING)
+    from spotify_session import RequestSpotify
+
+    user_id = 'bench-user'
+    app.token_manager.save_token(user_id, 'S', {'access_token': 'bench', 'refresh_token': 'bench',
+                                                'expires_at': time.time() + 86400})
+    client = app.app.test_client()
+
+    def most_similar_song():
+        response = client.post('/most_similar_song', data={'user_id': user_id, 'Catalog': 'Master'})
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    # the build runs as a background job, time it through to the job finishing
+    def artist_playlist():
+        response = client.post('/artist_playlist', data={'user_id': user_id})
+        assert response.status_code == 202, response.get_data(as_text=True)
+        job = app.jobs.wait(response.get_json()['id'])
+        assert job['status'] == 'done', job
+
+    # without a warm step the first request pays for the catalog download + compile + indexes
+    results = {'rows': n_rows, 'import_seconds': round(import_seconds, 3)}
+    start = time.perf_counter()
+    most_similar_song()
+    results['cold_most_similar_song_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    results['time_to_first_response_ms'] = round((time.perf_counter() - import_start) * 1000, 3)
+    results['boot'] = dict(app.boot)
+
+    catalog = app.catalog_cache.get('S', 'Master_Catalog')
+    response = app.catalog_cache.http.get(app.catalog_cache.url('S', 'Master_Catalog'))
+
+    def sp():
+        return RequestSpotify(app.token_manager.client(user_id)[0])
+
+    benches = {
+        'POST /most_similar_song': most_similar_song,
+        'POST /artist_playlist': artist_playlist,
+        'best_next_songs': lambda: app.best_next_songs(sp(), catalog),
+        'artist_cat': lambda: app.artist_cat(sp(), catalog, [artist]),
+        'read_csv_with_encoding': lambda: app.read_csv_with_encoding(response),
+    }
+    for name, fn in benches.items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(fn, args.iterations, args.warmup, args.max_seconds, spotify_state)
+        print(f"  {n_rows:>8} rows  {name:<26} p50 {results[name]['p50_ms']:>9.2f} ms  "
+              f"p99 {results[name]['p99_ms']:>9.2f} ms", file=sys.stderr)
+
+    results['catalog_bytes_fetched'] = CatalogFileHandler.bytes_sent
+    results['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    spotify_server.shutdown()
+    catalog_server.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# p50 of every benchmark in both files, side by side
+def compare(old, new):
+    lines = [f"{'rows':>8}  {'benchmark':<26} {'old p50':>10} {'new p50':>10} {'change':>8}"]
+    for size, results in new['sizes'].items():
+        for name, stats in results.items():
+            before = old.get('sizes', {}).get(size, {}).get(name)
+            if not isinstance(stats, dict) or not isinstance(before, dict):
+                continue
+            change = (stats['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0.0
+            lines.append(f"{size:>8}  {name:<26} {before['p50_ms']:>10.2f} {stats['p50_ms']:>10.2f} {change:>+7.1f}%")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the similarity and artist playlist paths offline')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='catalog sizes (rows), comma separated')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--max-seconds', type=float, default=20, help='stop a benchmark early after this long')
+    parser.add_argument('--spotify-latency', type=float, default=0, help='added to every fake spotify call (ms)')
+    parser.add_argument('--catalog-latency', type=float, default=0, help='added to every catalog download (ms)')
+    parser.add_argument('--rate-limit', type=float, default=1000, help='SPOTIFY_RATE_LIMIT for the run (calls/s)')
+    parser.add_argument('--seed', type=int, default=0, help='synthetic catalog seed')
+    parser.add_argument('--warm', choices=['off', 'block', 'background'], default='off',
+                        help="app's WARM_ON_BOOT for the run (block counts the warm step in import time)")
+    parser.add_argument('--only', action='append', help='only run this benchmark (repeatable)')
+    parser.add_argument('-o', '--output', help='results json (default: bench_results/<commit>.json)')
+    parser.add_argument('--compare', help='older results json to compare against')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-output', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # the app prints and logs to stdout, so a worker hands its results back in a file
+    if args.worker:
+        results = run_size(args.worker, args)
+        with open(args.worker_output, 'w') as f:
+            json.dump(results, f)
+        return 0
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('worker', 'worker_output', 'output', 'compare')},
+        'sizes': {},
+    }
+    passthrough = list(argv if argv is not None else sys.argv[1:])
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        print(f"Catalog of {size} rows", file=sys.stderr)
+        catalog_dir(size, args.seed)
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            worker_output = f.name
+        try:
+            worker = subprocess.run([sys.executable, os.path.abspath(__file__), *passthrough, '--worker', str(size),
+                                     '--worker-output', worker_output], cwd=HERE, stdout=subprocess.DEVNULL)
+            if worker.returncode != 0:
+                print(f"Benchmark of {size} rows failed", file=sys.stderr)
+                return worker.returncode
+            with open(worker_output) as f:
+                results['sizes'][str(size)] = json.load(f)
+        finally:
+            os.remove(worker_output)
+
+    output = args.output or os.path.join(BENCH_RESULTS, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results -> {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import numpy as np
+
+"""
+BOAT: a playlist drawn from one gaussian around the mean of a parameter region.
+
+The mean and covariance come from a seed set of songs (liked songs, a playlist csv, ...). Every catalog track
+is scored by its Mahalanobis distance to that gaussian in one vectorized pass, then n tracks are drawn
+without replacement with probability proportional to the gaussian density. The draw uses the gumbel top-k
+trick (top k of log weight + gumbel noise), which is exactly weighted sampling without replacement, works
+in log space so far away tracks don't underflow, and is one argpartition. Pass seed= to get the same draw back.
+"""
+
+
+class GaussianSampler:
+
+    def __init__(self, seed_features, fallback_std=None, ridge=0.05, spread=1.0):
+        seed_features = np.asarray(seed_features, dtype=np.float64)
+        seed_features = seed_features[~np.isnan(seed_features).any(axis=1)]
+        if len(seed_features) == 0:
+            raise ValueError("No seed songs with audio features")
+        n_params = seed_features.shape[1]
+
+        self.mean = seed_features.mean(axis=0)
+        cov = np.cov(seed_features, rowvar=False) if len(seed_features) > 1 else np.zeros((n_params, n_params))
+
+        # ridge keeps the covariance invertible for tiny / flat seed sets, sized off the whole catalog's spread
+        scale = np.ones(n_params) if fallback_std is None else np.asarray(fallback_std, dtype=np.float64)
+        cov = (np.atleast_2d(cov) + np.diag((ridge * scale) ** 2)) * spread ** 2
+        self.cov = cov
+
+        # d^2 = |L^-1 (x - mean)|^2 with cov = L L^T, so one matmul scores the whole catalog
+        self.whiten = np.linalg.inv(np.linalg.cholesky(cov)).T
+        self.seed_size = len(seed_features)
+
+    # Squared Mahalanobis distance of every row (inf for rows missing a feature)
+    def mahalanobis2(self, features):
+        diff = np.asarray(features, dtype=np.float64) - self.mean
+        white = diff @ self.whiten
+        d2 = np.einsum('ij,ij->i', white, white)
+        d2[np.isnan(d2)] = np.inf
+        return d2
+
+    # n row positions drawn without replacement, weight = gaussian density, candidates = optional row mask
+    def sample(self, features, n, candidates=None, track_ids=None, seed=None):
+        rng = np.random.default_rng(seed)
+        log_weights = -0.5 * self.mahalanobis2(features)
+        if candidates is not None:
+            log_weights[~candidates] = -np.inf
+
+        keys = log_weights + rng.gumbel(size=len(log_weights))
+        available = int(np.isfinite(keys).sum())
+        if available == 0 or n <= 0:
+            return np.array([], dtype=np.intp)
+
+        # take a few extra so duplicate rows of the same track can be dropped without a second pass
+        k = min(available, n * 2 if track_ids is not None else n)
+        rows = np.argpartition(-keys, k - 1)[:k] if k < len(keys) else np.arange(len(keys))
+        rows = rows[np.argsort(-keys[rows], kind='stable')]
+        rows = rows[np.isfinite(keys[rows])]
+
+        if track_ids is None:
+            return rows[:n]
+        picked, seen = [], set()
+        for row in rows:
+            if track_ids[row] in seen:
+                continue
+            seen.add(track_ids[row])
+            picked.append(row)
+            if len(picked) == n:
+                break
+        return np.array(picked, dtype=np.intp)
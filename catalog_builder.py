@@ -0,0 +1,284 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+from similarity import MISSING_RATING
+
+"""
+Merge every playlist csv in a *_playlists folder into that folder's Master_Catalog.csv.
+
+    python catalog_builder.py                       # S_playlists/ and C_playlists/
+    python catalog_builder.py S_playlists --membership s_membership.csv
+    python catalog_builder.py --full                # ignore the manifest, reprocess every csv
+
+The csvs are streamed in chunks into a small SQLite file per folder (CATALOG_BUILD_DIR), so memory stays
+flat however many playlists there are. Rows are deduplicated by Track ID: a row with ratings beats one full of
+-99s, and the Master catalog's own rows beat the playlists'. The same pass fills a track -> playlists
+membership table. A manifest of each csv's size, mtime and sha256 is kept there too, so a rebuild only
+reprocesses csvs that actually changed (an edited mtime with the same hash is just recorded).
+Master_Catalog.csv is then rewritten (its own rows keep their order, new tracks go on the end), only if
+something changed.
+"""
+
+CATALOG_BUILD_DIR = os.environ.get('CATALOG_BUILD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog_build'))
+CATALOG_COLUMNS = ['Track ID', 'Track Name', 'Artist(s)', 'Album', 'Danceability Rating', 'Energy Rating', 'Key Rating',
+                   'Loudness Rating', 'Mode Rating', 'Speechiness Rating', 'Acousticness Rating', 'Instrumentalness Rating',
+                   'Liveness Rating', 'Valence Rating', 'Tempo Rating']
+MASTER_NAME = 'Master_Catalog'
+CHUNK_ROWS = 2000
+
+# which copy of a track wins: higher priority replaces lower
+NO_RATINGS, PLAYLIST_RATINGS, MASTER_RATINGS = 0, 1, 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id TEXT PRIMARY KEY,
+    fields TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS membership (
+    track_id TEXT NOT NULL,
+    playlist TEXT NOT NULL,
+    PRIMARY KEY (track_id, playlist)
+);
+CREATE INDEX IF NOT EXISTS membership_playlist ON membership (playlist);
+"""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 'Jazz.csv' -> 'Jazz' (not os.path.splitext, that keeps '....................csv' whole)
+def playlist_name(filename):
+    return filename[:-len('.csv')] if filename.lower().endswith('.csv') else filename
+
+
+# Chunks of a catalog csv as lists of CATALOG_COLUMNS values, kept as the exact text in the file
+def read_chunks(path, chunk_rows=CHUNK_ROWS):
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        try:
+            reader = pd.read_csv(f, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+            for chunk in reader:
+                missing = [c for c in CATALOG_COLUMNS if c not in chunk.columns]
+                if missing:
+                    raise ValueError(f"missing columns {missing}")
+                yield chunk[CATALOG_COLUMNS].values.tolist()
+        except pd.errors.EmptyDataError:
+            return
+
+
+# '\r\n' if the file's first line ends that way, so a rewrite doesn't touch every line
+def line_ending(path):
+    if not os.path.exists(path):
+        return '\n'
+    with open(path, 'rb') as f:
+        return '\r\n' if f.readline().endswith(b'\r\n') else '\n'
+
+
+def has_ratings(fields):
+    for value in fields[4:]:
+        try:
+            if float(value) != MISSING_RATING:
+                return True
+        except ValueError:
+            pass
+    return False
+
+
+class CatalogBuilder:
+
+    def __init__(self, folder, build_dir=CATALOG_BUILD_DIR, chunk_rows=CHUNK_ROWS):
+        self.folder = folder
+        self.chunk_rows = chunk_rows
+        self.master_path = os.path.join(folder, f"{MASTER_NAME}.csv")
+        os.makedirs(build_dir, exist_ok=True)
+        self.db_path = os.path.join(build_dir, f"{os.path.basename(os.path.normpath(folder))}.db")
+        self.db = sqlite3.connect(self.db_path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    # Every csv in the folder, Master first so its rows get in before the playlists'
+    def csv_files(self):
+        names = sorted(name for name in os.listdir(self.folder) if name.lower().endswith('.csv'))
+        return sorted(names, key=lambda name: playlist_name(name) != MASTER_NAME)
+
+    # What changed since the last build: (changed names, removed names, names whose mtime moved but not their content)
+    def diff_manifest(self, full=False):
+        known = {row[0]: row[1:] for row in self.db.execute('SELECT name, size, mtime, sha256 FROM files')}
+        changed, touched = [], []
+        names = self.csv_files()
+        for name in names:
+            stat = os.stat(os.path.join(self.folder, name))
+            if name not in known or full:
+                changed.append(name)
+                continue
+            size, mtime, sha256 = known[name]
+            if size == stat.st_size and mtime == stat.st_mtime:
+                continue
+            if size == stat.st_size and sha256 == file_sha256(os.path.join(self.folder, name)):
+                touched.append(name)
+            else:
+                changed.append(name)
+        removed = [name for name in known if name not in set(names)]
+        return changed, removed, touched
+
+    def build(self, full=False, log=print):
+        start = time.perf_counter()
+        changed, removed, touched = self.diff_manifest(full)
+
+        for name in touched:
+            self._record(name, rows=None)
+        for name in removed:
+            with self.db:
+                self.db.execute('DELETE FROM membership WHERE playlist = ?', (playlist_name(name),))
+                self.db.execute('DELETE FROM files WHERE name = ?', (name,))
+            log(f"  removed {name}")
+        for name in changed:
+            try:
+                rows = self._ingest(name)
+            except (ValueError, OSError, pd.errors.ParserError) as e:
+                log(f"  skipped {name}: {e}")
+                continue
+            log(f"  {name}: {rows} rows")
+
+        wrote = False
+        if changed or removed or not os.path.exists(self.master_path):
+            wrote = self.write_master()
+        n_tracks = self.db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        log(f"{self.folder}: {len(changed)} changed, {len(removed)} removed, {len(touched)} touched, "
+            f"{n_tracks} tracks{' (Master_Catalog.csv rewritten)' if wrote else ''} in {time.perf_counter() - start:.2f}s")
+        return changed, removed
+
+    # Stream one csv into the tracks / membership tables, all in one transaction
+    def _ingest(self, name):
+        path = os.path.join(self.folder, name)
+        playlist = playlist_name(name)
+        is_master = playlist == MASTER_NAME
+        rows = 0
+        with self.db:
+            self.db.execute('DELETE FROM membership WHERE playlist = ?', (playlist,))
+            for chunk in read_chunks(path, self.chunk_rows):
+                records = []
+                for fields in chunk:
+                    track_id = fields[0].strip()
+                    if not track_id:
+                        continue
+                    if has_ratings(fields):
+                        priority = MASTER_RATINGS if is_master else PLAYLIST_RATINGS
+                    else:
+                        priority = NO_RATINGS
+                    records.append((track_id, json.dumps(fields, ensure_ascii=False), priority, name))
+                # better copy of the track wins, the file that owns a row can always update it
+                self.db.executemany(
+                    'INSERT INTO tracks VALUES (?, ?, ?, ?) ON CONFLICT(track_id) DO UPDATE SET '
+                    'fields = excluded.fields, priority = excluded.priority, source = excluded.source '
+                    'WHERE excluded.priority > tracks.priority OR excluded.source = tracks.source', records)
+                if not is_master:
+                    self.db.executemany('INSERT OR IGNORE INTO membership VALUES (?, ?)',
+                                        [(record[0], playlist) for record in records])
+                rows += len(records)
+            self._record(name, rows)
+        return rows
+
+    def _record(self, name, rows):
+        path = os.path.join(self.folder, name)
+        stat = os.stat(path)
+        if rows is None:
+            rows = self.db.execute('SELECT rows FROM files WHERE name = ?', (name,)).fetchone()[0]
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                            (name, stat.st_size, stat.st_mtime, file_sha256(path), rows))
+
+    # Rewrite Master_Catalog.csv from the tracks table (streamed, in the order tracks first showed up), False if nothing changed
+    def write_master(self):
+        tmp_path = f"{self.master_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, lineterminator=line_ending(self.master_path))
+            writer.writerow(CATALOG_COLUMNS)
+            cursor = self.db.execute('SELECT fields FROM tracks ORDER BY rowid')
+            while True:
+                batch = cursor.fetchmany(self.chunk_rows)
+                if not batch:
+                    break
+                writer.writerows(json.loads(fields) for (fields,) in batch)
+
+        if os.path.exists(self.master_path) and file_sha256(tmp_path) == file_sha256(self.master_path):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, self.master_path)
+        # the Master we just wrote is what's in the tables, no need to read it back next time
+        n_tracks = self.db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        self._record(os.path.basename(self.master_path), rows=n_tracks)
+        return True
+
+    # Playlists a track is on
+    def playlists_for(self, track_id):
+        return [row[0] for row in self.db.execute(
+            'SELECT playlist FROM membership WHERE track_id = ? ORDER BY playlist', (track_id,))]
+
+    # Track ID -> playlists as csv, streamed
+    def write_membership(self, path):
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['Track ID', 'Playlists'])
+            cursor = self.db.execute(
+                "SELECT track_id, group_concat(playlist, '; ') FROM "
+                "(SELECT track_id, playlist FROM membership ORDER BY track_id, playlist) GROUP BY track_id ORDER BY track_id")
+            while True:
+                batch = cursor.fetchmany(self.chunk_rows)
+                if not batch:
+                    break
+                writer.writerows(batch)
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Merge playlist csvs into Master_Catalog.csv')
+    parser.add_argument('folders', nargs='*', help='playlist folders (default: every *_playlists folder)')
+    parser.add_argument('--full', action='store_true', help='ignore the manifest and reprocess every csv')
+    parser.add_argument('--membership', help='also write the track -> playlists index here as csv (one folder only)')
+    parser.add_argument('--build-dir', default=CATALOG_BUILD_DIR, help='where the build state is kept')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='rows read / written at a time')
+    args = parser.parse_args(argv)
+
+    folders = args.folders or sorted(os.path.join(here, name) for name in os.listdir(here)
+                                     if name.endswith('_playlists') and os.path.isdir(os.path.join(here, name)))
+    if args.membership and len(folders) != 1:
+        parser.error('--membership needs exactly one folder')
+
+    for folder in folders:
+        builder = CatalogBuilder(folder, build_dir=args.build_dir, chunk_rows=args.chunk_rows)
+        try:
+            builder.build(full=args.full)
+            if args.membership:
+                builder.write_membership(args.membership)
+                print(f"Membership index -> {args.membership}")
+        finally:
+            builder.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+import requests
+from collections import OrderedDict
+from urllib.parse import quote
+import threading
+import logging
+import time
+import os
+
+from similarity import SimilarityEngine
+from catalog_indexes import ArtistIndex, KeyIndex, SpectrumIndex, TitleIndex, index_arrays
+from catalog_store import (COMPILED_DIR, CompiledCatalog, compiled_path, file_generation, generation_lock,
+                           list_catalog_files, read_catalog_bytes)
+from metrics import CATALOG_BYTES, span
+
+"""
+In-process cache for the catalog csvs.
+
+Entries are keyed by (user_abbrev, catalog name) and hold the compiled catalog arrays plus everything
+derived from them (similarity engine, indexes from catalog_indexes.py). Every fetched csv is compiled to a .mcat file (see catalog_store.py)
+and memory mapped, and preload() maps every compiled file at startup, so a catalog is only parsed as text
+when it actually changed. After CATALOG_CACHE_TTL seconds an entry is revalidated
+with a conditional GET (If-None-Match), so an unchanged catalog costs a 304 instead of a download + parse.
+Entries are evicted least recently used first once the total size goes over CATALOG_CACHE_MAX_MB.
+If github can't be reached we fall back to the compiled copy or the local S_playlists/ C_playlists/ csvs.
+
+The compiled files (indexes included) are also how gunicorn workers share catalogs. A worker that downloads a new
+version writes the next generation (under generation_lock, so only for catalogs that exist) and renames it into
+place, and a 304 just touches the file, so its mtime is when the catalog was last checked. Every other worker
+notices the new inode or the newer mtime on its next lookup (one stat) and maps that file instead of going to
+github itself, and one that was downloading the same version at the same time maps it instead of parsing its
+copy, so N workers cost one copy of each catalog in memory (the page cache), not N. Nobody waits on a lock
+while github answers.
+"""
+
+CATALOG_BASE_URL = os.environ.get('CATALOG_BASE_URL', 'https://raw.githubusercontent.com/seamusmcn/seamusmcn.github.io/main')
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', 300))
+CATALOG_CACHE_MAX_MB = float(os.environ.get('CATALOG_CACHE_MAX_MB', 256))
+LOCAL_CATALOG_DIR = os.environ.get('LOCAL_CATALOG_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+
+class CatalogEntry:
+
+    def __init__(self, key, catalog, etag=None, source='remote', load_seconds=0.0):
+        self.key = key
+        if not catalog.indexed:
+            catalog.arrays.update(index_arrays(catalog))
+        self.catalog = catalog
+        self.engine = SimilarityEngine.from_catalog(catalog)
+        self.spectrum = SpectrumIndex(catalog.arrays)
+        self.keys = KeyIndex(catalog.arrays)
+        self.artist_index = ArtistIndex(catalog.arrays)
+        self.titles = TitleIndex(catalog.arrays)
+        self.etag = etag
+        self.source = source
+        self.load_seconds = load_seconds
+        self.checked_at = time.time()
+        self.nbytes = catalog.nbytes
+        self._frame = None
+
+    # Arrays (features, track_ids, track_names, artists, ...) come straight from the compiled catalog
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'catalog':
+            raise AttributeError(name)
+        return getattr(self.catalog, name)
+
+    def __len__(self):
+        return len(self.catalog)
+
+    # DataFrame view, only built if something asks for it
+    @property
+    def frame(self):
+        if self._frame is None:
+            self._frame = self.catalog.to_frame()
+        return self._frame
+
+
+class CatalogCache:
+
+    def __init__(self, base_url=CATALOG_BASE_URL, ttl=CATALOG_CACHE_TTL, max_bytes=CATALOG_CACHE_MAX_MB * 1024 * 1024,
+                 local_dir=LOCAL_CATALOG_DIR, compiled_dir=COMPILED_DIR, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.compiled_dir = compiled_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.local_dir = local_dir
+        self.timeout = timeout
+        self.http = requests.Session()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'revalidated': 0,
+            'refreshed': 0,
+            'fallbacks': 0,
+            'attached': 0,
+            'evictions': 0,
+            'seconds_saved': 0.0
+        }
+
+    def url(self, user_abbrev, name):
+        return f"{self.base_url}/{user_abbrev}_playlists/{quote(name)}.csv"
+
+    def local_path(self, user_abbrev, name):
+        return os.path.join(self.local_dir, f"{user_abbrev}_playlists", f"{name}.csv")
+
+    def compiled_path(self, user_abbrev, name):
+        return compiled_path(user_abbrev, name, compiled_dir=self.compiled_dir) if self.compiled_dir else None
+
+    # Names of the catalogs documented for a user: the csvs in its local *_playlists folder plus the compiled ones
+    def documented(self, user_abbrev):
+        names = set()
+        folders = [(self.local_dir, '.csv'), (self.compiled_dir, '.mcat')]
+        for root, extension in folders:
+            folder = os.path.join(root, f"{user_abbrev}_playlists") if root else None
+            if folder and os.path.isdir(folder):
+                # not os.path.splitext, that keeps '....................csv' whole
+                names.update(f[:-len(extension)] for f in os.listdir(folder) if f.lower().endswith(extension))
+        return names
+
+    # Return the CatalogEntry for a catalog, or None if it isn't documented anywhere. The name ends up in file
+    # paths, so anything that could leave the user's folder is a ValueError
+    def get(self, user_abbrev, name):
+        if not name or any(c in name for c in ('/', '\\', '\x00')):
+            raise ValueError(f"Bad catalog name {name!r}")
+        key = (user_abbrev, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            entry = self._follow(entry)
+            if time.time() - entry.checked_at < self.ttl:
+                self._hit(entry)
+                return entry
+
+        # another process may already have this catalog compiled
+        if entry is None:
+            entry = self._attach(key)
+            if entry is not None and time.time() - entry.checked_at < self.ttl:
+                self._hit(entry)
+                return entry
+
+        # the (conditional) fetch runs without any lock, only writing a new generation takes one
+        if entry is not None:
+            return self._revalidate(entry)
+
+        self._count('misses')
+        return self._load(key)
+
+    # Switch to the generation on disk if another process wrote a newer one, and take its check time
+    def _follow(self, entry):
+        path = entry.catalog.path
+        if path is None:
+            return entry
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return entry
+        if (stat.st_dev, stat.st_ino) == entry.catalog.generation:
+            entry.checked_at = max(entry.checked_at, stat.st_mtime)
+            return entry
+
+        catalog = self._open_compiled(entry.key)
+        if catalog is None:
+            return entry
+        self._count('attached')
+        followed = CatalogEntry(entry.key, catalog, etag=catalog.etag, source='shared')
+        followed.checked_at = stat.st_mtime
+        self._insert(followed)
+        logging.debug(f"Catalog {entry.key} has a new generation, mapped it")
+        return followed
+
+    # Map the compiled copy another process left for a catalog we don't have yet
+    def _attach(self, key):
+        catalog = self._open_compiled(key)
+        if catalog is None:
+            return None
+        self._count('attached')
+        entry = CatalogEntry(key, catalog, etag=catalog.etag, source='shared')
+        entry.checked_at = os.path.getmtime(catalog.path)
+        self._insert(entry)
+        return entry
+
+    # Mark entry as just checked, for every process (the compiled file's mtime is the shared check time)
+    def _checked(self, entry):
+        entry.checked_at = time.time()
+        if entry.catalog.path is not None and file_generation(entry.catalog.path) == entry.catalog.generation:
+            try:
+                os.utime(entry.catalog.path)
+            except OSError as e:
+                logging.debug(f"Could not touch {entry.catalog.path}: {e}")
+
+    def _revalidate(self, entry):
+        headers = {'If-None-Match': entry.etag} if entry.etag else {}
+        try:
+            start = time.perf_counter()
+            with span('catalog_fetch'):
+                response = self.http.get(self.url(*entry.key), headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            # github is down, keep serving what we have
+            logging.warning(f"Revalidating {entry.key} failed, serving cached copy: {e}")
+            self._checked(entry)
+            self._hit(entry)
+            return entry
+
+        if response.status_code == 304:
+            self._checked(entry)
+            self._count('revalidated')
+            self._hit(entry)
+            return entry
+
+        if response.status_code == 200:
+            self._count('refreshed')
+            return self._store(entry.key, response, start)
+
+        if response.status_code == 404:
+            self.invalidate(*entry.key)
+            return None
+
+        logging.warning(f"Revalidating {entry.key} returned {response.status_code}, serving cached copy")
+        self._checked(entry)
+        self._hit(entry)
+        return entry
+
+    def _load(self, key):
+        start = time.perf_counter()
+        try:
+            with span('catalog_fetch'):
+                response = self.http.get(self.url(*key), timeout=self.timeout)
+        except requests.RequestException as e:
+            logging.warning(f"Fetching {key} failed, trying local copy: {e}")
+            return self._load_local(key, start)
+
+        if response.status_code == 200:
+            return self._store(key, response, start)
+        if response.status_code == 404:
+            return None
+
+        logging.warning(f"Fetching {key} returned {response.status_code}, trying local copy")
+        return self._load_local(key, start)
+
+    def _load_local(self, key, start):
+        path = self.local_path(*key)
+        mapped = self._open_compiled(key)
+        if mapped is not None and (not os.path.exists(path) or os.path.getmtime(mapped.path) >= os.path.getmtime(path)):
+            catalog = mapped
+        elif os.path.exists(path):
+            catalog = CompiledCatalog.from_csv(path)
+        else:
+            return None
+        self._count('fallbacks')
+        # no etag so the next lookup after the ttl tries github again
+        entry = CatalogEntry(key, catalog, source='local', load_seconds=time.perf_counter() - start)
+        self._insert(entry)
+        return entry
+
+    def _store(self, key, response, start):
+        etag = response.headers.get('ETag')
+        CATALOG_BYTES.inc(len(response.content))
+        # another process fetched this same version while we were, map what it wrote instead of parsing it again
+        mapped = self._open_compiled(key)
+        if etag and mapped is not None and mapped.etag == etag:
+            self._count('attached')
+            entry = CatalogEntry(key, mapped, etag=etag, source='shared')
+            self._insert(entry)
+            return entry
+
+        with span('catalog_parse'):
+            catalog = CompiledCatalog.from_frame(read_catalog_bytes(response.content), etag=etag, source=f"{key[1]}.csv")
+        with span('catalog_index'):
+            catalog.arrays.update(index_arrays(catalog))
+        catalog = self._compile(key, catalog)
+        entry = CatalogEntry(key, catalog, etag=etag, load_seconds=time.perf_counter() - start)
+        self._insert(entry)
+        return entry
+
+    # Write the freshly parsed catalog out as the next generation and map it back, so the parsed copy can be dropped
+    def _compile(self, key, catalog):
+        if not self.compiled_dir:
+            return catalog
+        path = self.compiled_path(*key)
+        try:
+            with generation_lock(path):
+                # lost the race to a process that stored the same version, share its generation
+                current = self._open_compiled(key)
+                if current is not None and catalog.etag and current.etag == catalog.etag:
+                    return current
+                return CompiledCatalog.open(catalog.write(path))
+        except OSError as e:
+            logging.warning(f"Could not write compiled catalog for {key}, keeping it in memory: {e}")
+            return catalog
+
+    def _open_compiled(self, key):
+        if not self.compiled_dir:
+            return None
+        path = self.compiled_path(*key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return CompiledCatalog.open(path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring compiled catalog {path}: {e}")
+            return None
+
+    # Map every compiled catalog at startup, each one is revalidated against github on first use (unless
+    # another worker checked it less than ttl seconds ago)
+    def preload(self):
+        if not self.compiled_dir:
+            return 0
+        loaded = 0
+        for path in list_catalog_files(self.compiled_dir, '.mcat'):
+            user_abbrev = os.path.basename(os.path.dirname(path)).split('_')[0]
+            key = (user_abbrev, os.path.basename(path)[:-len('.mcat')])
+            catalog = self._open_compiled(key)
+            if catalog is None:
+                continue
+            entry = CatalogEntry(key, catalog, etag=catalog.etag, source='compiled')
+            entry.checked_at = 0
+            self._insert(entry)
+            loaded += 1
+        logging.debug(f"Mapped {loaded} compiled catalogs")
+        return loaded
+
+    def _insert(self, entry):
+        with self._lock:
+            self._entries[entry.key] = entry
+            self._entries.move_to_end(entry.key)
+            # evict least recently used, but always keep the entry we just loaded
+            while len(self._entries) > 1 and self._total_bytes() > self.max_bytes:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+                logging.debug(f"Evicted catalog {evicted_key} from cache")
+
+    def _total_bytes(self):
+        return sum(entry.nbytes for entry in self._entries.values())
+
+    def _hit(self, entry):
+        with self._lock:
+            self._counters['hits'] += 1
+            self._counters['seconds_saved'] += entry.load_seconds
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def invalidate(self, user_abbrev, name):
+        with self._lock:
+            self._entries.pop((user_abbrev, name), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Hit/miss counters plus what is currently cached
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._total_bytes()
+            stats['max_bytes'] = self.max_bytes
+            stats['catalogs'] = ['/'.join(key) for key in self._entries]
+        return stats
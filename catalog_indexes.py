@@ -0,0 +1,365 @@
+import numpy as np
+from collections import deque
+import re
+from functools import lru_cache
+
+from similarity import AUDIO_FEATURE_KEYS, FEATURE_COLUMNS
+from catalog_store import StringTable
+
+"""
+Indexes built once when a catalog is compiled and reused by every request, so the buttons never have to scan
+the catalog. Each index is a handful of numpy arrays: build() makes them, index_arrays() makes them all for a
+catalog, and they get written into the .mcat file with the catalog (see catalog_store.py). The index objects
+just wrap the arrays they are given, so every worker that maps the file shares the same pages.
+
+SpectrumIndex: per parameter argsort + quantile bin boundaries, a spectrum playlist is just slices.
+KeyIndex: (key, mode) -> row positions, plus circle of fifths / relative major-minor neighbours.
+ArtistIndex: artist name -> row positions (whole names, so "Wings" doesn't match "Wings of Pegasus", and a
+comma only splits a credit into artists the catalog has on their own).
+ArtistGraph: artist_associations.json as a graph, associates expanded to any depth with a cached BFS.
+TitleIndex: normalized title -> row positions, so covers of a song are one hash lookup.
+"""
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+MODE_NAMES = {0: 'minor', 1: 'major'}
+MODE_COLUMN = FEATURE_COLUMNS.index('Mode Rating')
+
+# 'danceability', 'Danceability' and 'Danceability Rating' all mean column 0
+PARAMETERS = {}
+for _j, (_key, _column) in enumerate(zip(AUDIO_FEATURE_KEYS, FEATURE_COLUMNS)):
+    PARAMETERS[_key] = _j
+    PARAMETERS[_column.lower()] = _j
+
+
+def parameter_index(parameter):
+    j = PARAMETERS.get(str(parameter).strip().lower())
+    if j is None:
+        raise ValueError(f"Unknown parameter: {parameter}")
+    return j
+
+
+# 'tempo' -> 'Tempo'
+def parameter_name(parameter):
+    return FEATURE_COLUMNS[parameter_index(parameter)][:-len(' Rating')]
+
+
+class SpectrumIndex:
+
+    def __init__(self, arrays):
+        self.order = arrays['spectrum_order']
+        self.counts = arrays['spectrum_counts']
+        self.boundaries = arrays['spectrum_boundaries']
+        self.edges = arrays['spectrum_edges']
+        self.bins = self.boundaries.shape[1] - 1
+
+    @staticmethod
+    def build(features, bins=10):
+        n_params = features.shape[1]
+
+        # argsort puts NaN last, so the first counts[j] entries of order[j] are the rows that have a value
+        order = np.empty((n_params, len(features)), dtype=np.int32)
+        counts = np.empty(n_params, dtype=np.int64)
+        boundaries = np.empty((n_params, bins + 1), dtype=np.int64)
+        edges = np.full((n_params, bins + 1), np.nan, dtype=np.float32)
+        for j in range(n_params):
+            column = features[:, j]
+            order[j] = np.argsort(column, kind='stable')
+            counts[j] = int((~np.isnan(column)).sum())
+            boundaries[j] = np.linspace(0, counts[j], bins + 1).astype(np.int64)
+            if counts[j]:
+                at = np.minimum(boundaries[j], counts[j] - 1)
+                edges[j] = column[order[j][at]]
+        return {'spectrum_order': order, 'spectrum_counts': counts, 'spectrum_boundaries': boundaries, 'spectrum_edges': edges}
+
+    @property
+    def nbytes(self):
+        return self.order.nbytes + self.counts.nbytes + self.boundaries.nbytes + self.edges.nbytes
+
+    # Every row with a value for parameter, lowest to highest
+    def gradient(self, parameter, descending=False):
+        j = parameter_index(parameter)
+        rows = self.order[j][:self.counts[j]]
+        return rows[::-1] if descending else rows
+
+    # Rows in quantile bin b (0 = lowest) of parameter
+    def bin_rows(self, parameter, b):
+        j = parameter_index(parameter)
+        return self.order[j][self.boundaries[j][b]:self.boundaries[j][b + 1]]
+
+    # per_bin random rows from every bin, kept in gradient order (candidates: a boolean row mask, the bins are
+    # then quantiles of just those rows)
+    def spectrum(self, parameter, per_bin=10, descending=False, seed=None, candidates=None):
+        rng = np.random.default_rng(seed)
+        if candidates is not None:
+            gradient = self.gradient(parameter)
+            bins = np.array_split(gradient[candidates[gradient]], self.bins)
+        else:
+            bins = [self.bin_rows(parameter, b) for b in range(self.bins)]
+        picks = []
+        for rows in bins:
+            if len(rows) > per_bin:
+                rows = rows[np.sort(rng.choice(len(rows), size=per_bin, replace=False))]
+            picks.append(rows)
+        rows = np.concatenate(picks) if picks else np.array([], dtype=np.int32)
+        return rows[::-1] if descending else rows
+
+
+# 'A', 'a', 'Bb', '9' -> 9
+def key_index(key):
+    key = str(key).strip()
+    if key.isdigit() and int(key) < 12:
+        return int(key)
+    flats = {'Db': 'C#', 'Eb': 'D#', 'Gb': 'F#', 'Ab': 'G#', 'Bb': 'A#'}
+    key = key[:1].upper() + key[1:]
+    key = flats.get(key, key)
+    if key not in KEY_NAMES:
+        raise ValueError(f"Unknown key: {key}")
+    return KEY_NAMES.index(key)
+
+
+# 'major' / 'minor' / '1' / '0' -> 1 / 0
+def mode_index(mode):
+    mode = str(mode).strip().lower()
+    if mode in ('1', 'major', 'maj'):
+        return 1
+    if mode in ('0', 'minor', 'min'):
+        return 0
+    raise ValueError(f"Unknown mode: {mode}")
+
+
+def key_label(key, mode):
+    return f"{KEY_NAMES[key]} {MODE_NAMES[mode]}"
+
+
+# Keys that mix well with (key, mode): a fifth up, a fifth down and the relative major/minor
+def harmonic_neighbours(key, mode):
+    relative = ((key + 9) % 12, 0) if mode == 1 else ((key + 3) % 12, 1)
+    return [((key + 7) % 12, mode), ((key + 5) % 12, mode), relative]
+
+
+class KeyIndex:
+
+    def __init__(self, arrays):
+        self.rows = arrays['key_rows']
+        self.starts = arrays['key_starts']
+
+    @staticmethod
+    def build(keys, modes):
+        # one code per (key, mode): key * 2 + mode, rows missing either (NaN, or spotify's -1 = no key) get left out
+        has_key = (keys >= 0) & (keys < 12) & ((modes == 0) | (modes == 1))
+        rows = np.flatnonzero(has_key).astype(np.int32)
+        codes = keys[has_key].astype(np.int64) * 2 + modes[has_key].astype(np.int64)
+
+        # rows grouped by code, starts[c]:starts[c + 1] is the slice for code c
+        order = np.argsort(codes, kind='stable')
+        starts = np.zeros(25, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=24)[:24], out=starts[1:])
+        return {'key_rows': rows[order], 'key_starts': starts}
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.starts.nbytes
+
+    # Row positions in (key, mode), catalog order
+    def lookup(self, key, mode):
+        code = key * 2 + mode
+        return self.rows[self.starts[code]:self.starts[code + 1]]
+
+    # Row positions in (key, mode) and, if asked, its harmonic neighbours (the exact key first)
+    def playlist(self, key, mode, neighbours=False):
+        keys = [(key, mode)] + (harmonic_neighbours(key, mode) if neighbours else [])
+        return np.concatenate([self.lookup(k, m) for k, m in keys])
+
+    def counts(self):
+        return {key_label(code // 2, code % 2): int(self.starts[code + 1] - self.starts[code]) for code in range(24)}
+
+
+# "The Beatles " / "the beatles" -> "the beatles"
+def normalize_artist(name):
+    return ' '.join(str(name).split()).casefold()
+
+
+# Group rows by their code, returns (rows sorted by code, starts) so rows of code c are rows[starts[c]:starts[c + 1]]
+def _group_rows(codes, n_codes):
+    rows = np.argsort(codes, kind='stable').astype(np.int32)
+    starts = np.zeros(n_codes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n_codes)[:n_codes], out=starts[1:])
+    return rows, starts
+
+
+class ArtistIndex:
+
+    def __init__(self, arrays):
+        self.rows = arrays['artist_index_rows']
+        self.starts = arrays['artist_index_starts']
+        # sorted normalized names, name n is in the "Artist(s)" codes name_codes[name_starts[n]:name_starts[n + 1]]
+        self.names = StringTable(arrays['artist_index_blob'], arrays['artist_index_offsets'])
+        self.name_starts = arrays['artist_index_name_starts']
+        self.name_codes = arrays['artist_index_name_codes']
+
+    @staticmethod
+    def build(artists):
+        # artists is a StringColumn: work per unique "Artist(s)" string, then map those codes to rows
+        rows, starts = _group_rows(artists.codes, len(artists.table))
+
+        # the csvs join artists with ", " but some names have a comma in them ("Tyler, The Creator",
+        # "Earth, Wind & Fire"), so a credit can't just be split on commas. The whole credit is always
+        # indexed, a run of neighbouring pieces only if it's also a whole credit somewhere in the catalog
+        # (so "Drake, Rihanna" is found under Drake if Drake has solo songs, but "Earth" doesn't match
+        # "Earth, Wind & Fire" unless some song is credited to just Earth)
+        values = artists.table.strings()
+        credited = {normalize_artist(value) for value in values}
+        codes_for = {}
+        for code, value in enumerate(values):
+            pieces = [piece.strip() for piece in value.split(',')]
+            for i in range(len(pieces)):
+                for j in range(i + 1, len(pieces) + 1):
+                    name = normalize_artist(', '.join(pieces[i:j]))
+                    if name and (name in credited or j - i == len(pieces)):
+                        codes_for.setdefault(name, []).append(code)
+        names = sorted(codes_for)
+        table = StringTable.from_strings(names)
+        name_starts = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(codes_for[name]) for name in names], out=name_starts[1:])
+        name_codes = np.array([code for name in names for code in codes_for[name]], dtype=np.int32)
+        return {'artist_index_rows': rows, 'artist_index_starts': starts, 'artist_index_blob': table.blob,
+                'artist_index_offsets': table.offsets, 'artist_index_name_starts': name_starts,
+                'artist_index_name_codes': name_codes}
+
+    @property
+    def nbytes(self):
+        return (self.rows.nbytes + self.starts.nbytes + self.names.blob.nbytes + self.names.offsets.nbytes +
+                self.name_starts.nbytes + self.name_codes.nbytes)
+
+    # "Artist(s)" string codes that credit artist
+    def codes_for(self, artist):
+        n = self.names.find(normalize_artist(artist))
+        if n < 0:
+            return self.name_codes[:0]
+        return self.name_codes[self.name_starts[n]:self.name_starts[n + 1]]
+
+    def __contains__(self, artist):
+        return self.names.find(normalize_artist(artist)) >= 0
+
+    # Row positions of every song by any of the artists (a set union of the per-artist slices)
+    def rows_for(self, artists):
+        slices = []
+        for artist in artists:
+            for code in self.codes_for(artist):
+                slices.append(self.rows[self.starts[code]:self.starts[code + 1]])
+        if not slices:
+            return np.array([], dtype=np.int32)
+        return np.unique(np.concatenate(slices))
+
+    def mask_for(self, artists, size):
+        mask = np.zeros(size, dtype=bool)
+        mask[self.rows_for(artists)] = True
+        return mask
+
+
+class ArtistGraph:
+
+    def __init__(self, associations):
+        # keep the spelling from the json for display, look things up by normalized name
+        self.names = {}
+        self.edges = {}
+        for artist, associates in associations.items():
+            self.names.setdefault(normalize_artist(artist), artist)
+            for associate in associates:
+                self.names.setdefault(normalize_artist(associate), associate)
+            self.edges.setdefault(normalize_artist(artist), []).extend(normalize_artist(a) for a in associates)
+        self._related = lru_cache(maxsize=1024)(self._bfs)
+
+    # Associates of artist out to depth hops, closest first (depth 1 = what's in the json)
+    def related(self, artist, depth=1):
+        return list(self._related(normalize_artist(artist), depth))
+
+    def _bfs(self, start, depth):
+        seen = {start}
+        found = []
+        queue = deque([(start, 0)])
+        while queue:
+            artist, hops = queue.popleft()
+            if hops == depth:
+                continue
+            for associate in self.edges.get(artist, ()):
+                if associate not in seen:
+                    seen.add(associate)
+                    found.append(self.names[associate])
+                    queue.append((associate, hops + 1))
+        return tuple(found)
+
+
+_BRACKETS = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+
+# "Fly Me To The Moon (In Other Words) - Remastered 2008" -> "fly me to the moon"
+def normalize_title(title):
+    title = str(title).casefold()
+    # " - Remastered 2010", " - Live", " - Mono Version", ... everything after the dash is version info
+    stripped = _BRACKETS.sub(' ', title.split(' - ')[0])
+    # "(Nice Dream)", "[untitled]": the brackets are the whole title, keep what's in them
+    return _bare_title(stripped) or _bare_title(title)
+
+
+def _bare_title(title):
+    return ' '.join(_PUNCTUATION.sub('', title).replace('_', ' ').split())
+
+
+class TitleIndex:
+
+    def __init__(self, arrays):
+        # normalized titles, sorted, so a title's code is its position in the table
+        self.titles = StringTable(arrays['title_blob'], arrays['title_offsets'])
+        self.title_codes = arrays['title_codes']
+        self.rows = arrays['title_rows']
+        self.starts = arrays['title_starts']
+
+    @staticmethod
+    def build(track_names):
+        # normalize once per unique title string, then group rows by normalized title
+        normalized = [normalize_title(name) for name in track_names.table.strings()]
+        titles = sorted(set(normalized))
+        code_of = {title: code for code, title in enumerate(titles)}
+        title_of_name = np.array([code_of[title] for title in normalized], dtype=np.int32)
+        title_codes = title_of_name[track_names.codes] if len(normalized) else np.array([], dtype=np.int32)
+        rows, starts = _group_rows(title_codes, len(titles))
+        table = StringTable.from_strings(titles)
+        return {'title_blob': table.blob, 'title_offsets': table.offsets, 'title_codes': title_codes,
+                'title_rows': rows, 'title_starts': starts}
+
+    @property
+    def nbytes(self):
+        return (self.titles.blob.nbytes + self.titles.offsets.nbytes + self.title_codes.nbytes + self.rows.nbytes +
+                self.starts.nbytes)
+
+    # Every row whose title normalizes to the same thing as title ("--" and blank titles don't match anything)
+    def rows_for_title(self, title):
+        normalized = normalize_title(title)
+        code = self.titles.find(normalized) if normalized else -1
+        if code < 0:
+            return np.array([], dtype=np.int32)
+        return self.rows[self.starts[code]:self.starts[code + 1]]
+
+    # Rows with the same normalized title as any of rows, minus the rows in exclude (a boolean row mask). Titles
+    # that normalize to nothing ("--", blank) aren't the same song as each other
+    def same_title(self, rows, exclude=None):
+        codes = np.unique(self.title_codes[rows])
+        empty = self.titles.find('')
+        slices = [self.rows[self.starts[code]:self.starts[code + 1]] for code in codes if code != empty]
+        if not slices:
+            return np.array([], dtype=np.int32)
+        found = np.unique(np.concatenate(slices))
+        if exclude is not None:
+            found = found[~exclude[found]]
+        return found
+
+
+# Every index's arrays for a CompiledCatalog, to go in its .mcat file
+def index_arrays(catalog):
+    arrays = SpectrumIndex.build(catalog.features)
+    arrays.update(KeyIndex.build(catalog.key, catalog.features[:, MODE_COLUMN]))
+    arrays.update(ArtistIndex.build(catalog.artists))
+    arrays.update(TitleIndex.build(catalog.track_names))
+    return arrays
@@ -0,0 +1,374 @@
+import numpy as np
+import pandas as pd
+from io import StringIO
+import argparse
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # windows, no cross process locking (the dev server is one process anyway)
+    fcntl = None
+
+from similarity import FEATURE_COLUMNS, MISSING_RATING, feature_matrix, feature_stats, usable_rows
+
+"""
+Compact columnar format for the catalogs (.mcat).
+
+    python catalog_store.py                  # compile every *_playlists/*.csv into compiled_catalogs/
+    python catalog_store.py path/to/x.csv    # compile just these
+
+Layout: 8 byte magic, uint64 header length, json header, then 64-byte aligned arrays:
+    features   float32 (rows, 10)   the ten similarity "... Rating" columns, NaN = missing
+    key        float32 (rows,)      Key Rating
+    valid      bool    (rows,)      row has at least one feature
+    track_id   S22     (rows,)      interned track ids, id_order is their argsort for binary search lookups
+    name/artist/album: int32 codes into a string table (blob + offsets) of the unique values
+    spectrum_*, key_*, artist_index_*, title_*: the catalog_indexes.py indexes, so nothing is rebuilt on open
+
+The server mmaps these read only so nothing is parsed or copied when a catalog is loaded, and the
+pages are shared with every other process that maps the same file. A file is never written in place: a new
+version (generation) is written next to it and renamed over it, processes that still have the old one mapped
+keep reading it until they notice the new inode and map that instead. generation_lock() is how gunicorn
+workers agree on which one of them rebuilds a file.
+"""
+
+MAGIC = b'MCAT\x00\x01\x00\x00'
+FORMAT_VERSION = 5
+ALIGN = 64
+STRING_COLUMNS = {'name': 'Track Name', 'artist': 'Artist(s)', 'album': 'Album'}
+COMPILED_DIR = os.environ.get('CATALOG_COMPILED_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compiled_catalogs'))
+
+
+# Parse raw csv bytes into a DataFrame (BOM dropped, bad utf-8 replaced instead of blowing up)
+def read_catalog_bytes(content):
+    decoded_content = content.decode('utf-8-sig', errors='replace')
+    return pd.read_csv(StringIO(decoded_content))
+
+
+def _aligned(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+# Hold an exclusive lock on path + '.lock' (across processes, and across threads since each call opens its own file)
+@contextmanager
+def generation_lock(path):
+    if fcntl is None or path is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# (device, inode) of path, changes every time a new generation is renamed over it, None if it isn't there
+def file_generation(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+# Map a file written by write_arrays read only: (arrays, header, mmap), arrays are views straight onto the mapped pages
+def map_arrays(path, version=FORMAT_VERSION):
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        stat = os.fstat(f.fileno())
+    if buffer[:len(MAGIC)] != MAGIC:
+        buffer.close()
+        raise ValueError(f"{path} is not a compiled catalog")
+    (header_len,) = struct.unpack_from('<Q', buffer, len(MAGIC))
+    start = len(MAGIC) + 8
+    header = json.loads(bytes(buffer[start:start + header_len]).decode('utf-8'))
+    if header.get('version') != version:
+        buffer.close()
+        raise ValueError(f"{path} has format version {header.get('version')}, expected {version}")
+    header['generation'] = [stat.st_dev, stat.st_ino]
+
+    data_start = _aligned(start + header_len)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        if count == 0:
+            arrays[name] = np.empty(spec['shape'], dtype=dtype)
+            continue
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + spec['offset'])
+        arrays[name] = array.reshape(spec['shape'])
+    return arrays, header, buffer
+
+
+# Write arrays + a json header atomically (tmp file + rename) so readers never map a half written file
+def write_arrays(path, arrays, header):
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = {k: v for k, v in header.items() if k != 'generation'}
+    header_bytes = json.dumps(dict(header, arrays=layout)).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+
+# Unique strings stored as one utf-8 blob + offsets, strings only get decoded when asked for
+class StringTable:
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+        self._strings = None
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self._strings is not None:
+            return self._strings[i]
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    # Position of s in a table built from sorted strings (binary search, decodes ~log2(n) entries), -1 if missing
+    def find(self, s):
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < s:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self[lo] == s else -1
+
+    # Every string, decoded once and kept (only worth it for small tables like artists)
+    def strings(self):
+        if self._strings is None:
+            self._strings = [self[i] for i in range(len(self))]
+        return self._strings
+
+
+# A string column = int32 code per row into a StringTable
+class StringColumn:
+
+    def __init__(self, codes, table):
+        self.codes = codes
+        self.table = table
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.table[self.codes[i]]
+
+    # Boolean row mask of where predicate(value) is true, predicate runs once per unique value not per row
+    def matching(self, predicate):
+        hits = np.fromiter((predicate(s) for s in self.table.strings()), dtype=bool, count=len(self.table))
+        return hits[self.codes]
+
+    def to_list(self):
+        return [self.table[c] for c in self.codes]
+
+
+class CompiledCatalog:
+
+    def __init__(self, arrays, header, buffer=None, path=None):
+        self.arrays = arrays
+        self.header = header
+        self.path = path
+        self._buffer = buffer  # keeps the mmap alive
+
+        self.features = arrays['features']
+        self.key = arrays['key']
+        self.valid = arrays['valid']
+        self.track_ids = arrays['track_id']
+        self.id_order = arrays['id_order']
+        self.track_names = StringColumn(arrays['name_codes'], StringTable(arrays['name_blob'], arrays['name_offsets']))
+        self.artists = StringColumn(arrays['artist_codes'], StringTable(arrays['artist_blob'], arrays['artist_offsets']))
+        self.albums = StringColumn(arrays['album_codes'], StringTable(arrays['album_blob'], arrays['album_offsets']))
+        self.mean = np.asarray(header['mean'])
+        self.std = np.asarray(header['std'])
+        self.etag = header.get('etag')
+        self.generation = tuple(header['generation']) if 'generation' in header else None
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays.values())
+
+    @property
+    def mapped(self):
+        return self._buffer is not None
+
+    # Whether the catalog_indexes.py arrays are in here yet (see catalog_indexes.index_arrays)
+    @property
+    def indexed(self):
+        return 'spectrum_order' in self.arrays
+
+    @classmethod
+    def from_frame(cls, frame, etag=None, source=None):
+        columns = {c.strip(): c for c in frame.columns}
+        features = feature_matrix(frame)
+        valid = usable_rows(features)
+
+        key = np.full(len(frame), np.nan, dtype=np.float32)
+        if 'Key Rating' in columns:
+            key[:] = pd.to_numeric(frame[columns['Key Rating']], errors='coerce').to_numpy(dtype=np.float32)
+            key[key == MISSING_RATING] = np.nan
+
+        ids = frame[columns['Track ID']].fillna('').astype(str)
+        track_ids = np.array([s.encode('utf-8') for s in ids], dtype=bytes) if len(ids) else np.array([], dtype='S22')
+
+        arrays = {
+            'features': features,
+            'key': key,
+            'valid': valid,
+            'track_id': track_ids,
+            'id_order': np.argsort(track_ids, kind='stable').astype(np.int32)
+        }
+        for prefix, column in STRING_COLUMNS.items():
+            values = frame[column].fillna('').astype(str) if column in columns else pd.Series([''] * len(frame))
+            codes, uniques = pd.factorize(values.to_numpy(dtype=object))
+            table = StringTable.from_strings(list(uniques))
+            arrays[f'{prefix}_codes'] = codes.astype(np.int32)
+            arrays[f'{prefix}_blob'] = table.blob
+            arrays[f'{prefix}_offsets'] = table.offsets
+
+        mean, std = feature_stats(features, valid)
+
+        header = {
+            'version': FORMAT_VERSION,
+            'rows': len(frame),
+            'etag': etag,
+            'source': source,
+            'mean': mean.tolist(),
+            'std': std.tolist()
+        }
+        return cls(arrays, header)
+
+    @classmethod
+    def from_csv(cls, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        return cls.from_frame(read_catalog_bytes(content), source=os.path.basename(path))
+
+    # Map a compiled file read only, nothing is copied
+    @classmethod
+    def open(cls, path):
+        arrays, header, buffer = map_arrays(path)
+        return cls(arrays, header, buffer=buffer, path=path)
+
+    # Write atomically, a process that has the old file mapped keeps its copy
+    def write(self, path):
+        return write_arrays(path, self.arrays, self.header)
+
+    def track_id(self, i):
+        return self.track_ids[i].decode('utf-8')
+
+    # Row positions holding track_id, binary search over the interned ids (no copies of the id column)
+    def rows_for_id(self, track_id):
+        target = track_id.encode('utf-8')
+        lo, hi = 0, len(self.id_order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.track_ids[self.id_order[mid]] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        end = lo
+        while end < len(self.id_order) and self.track_ids[self.id_order[end]] == target:
+            end += 1
+        return np.sort(self.id_order[lo:end])
+
+    # Rebuild a DataFrame for code that still wants one (not needed for queries)
+    def to_frame(self):
+        frame = pd.DataFrame({
+            'Track ID': [self.track_id(i) for i in range(len(self))],
+            'Track Name': self.track_names.to_list(),
+            'Artist(s)': self.artists.to_list(),
+            'Album': self.albums.to_list()
+        })
+        for j, name in enumerate(FEATURE_COLUMNS):
+            frame[name] = self.features[:, j]
+        frame['Key Rating'] = self.key
+        return frame
+
+
+# Every file ending in extension inside the *_playlists folders under root
+def list_catalog_files(root, extension):
+    # not glob('*.csv'), that skips names starting with '.' like '....................csv'
+    paths = []
+    for folder in sorted(glob.glob(os.path.join(root, '*_playlists'))):
+        paths += [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.lower().endswith(extension)]
+    return paths
+
+
+# compiled_catalogs/S_playlists/Jazz.mcat for S_playlists/Jazz.csv
+def compiled_path(user_abbrev, name, compiled_dir=COMPILED_DIR):
+    return os.path.join(compiled_dir, f"{user_abbrev}_playlists", f"{name}.mcat")
+
+
+def compile_csv(csv_path, compiled_dir=COMPILED_DIR):
+    folder = os.path.basename(os.path.dirname(os.path.abspath(csv_path)))
+    # not os.path.splitext, that keeps '....................csv' whole
+    name = os.path.basename(csv_path)
+    if name.lower().endswith('.csv'):
+        name = name[:-len('.csv')]
+    out_path = os.path.join(compiled_dir, folder, f"{name}.mcat")
+    from catalog_indexes import index_arrays  # catalog_indexes imports this module
+    catalog = CompiledCatalog.from_csv(csv_path)
+    catalog.arrays.update(index_arrays(catalog))
+    with generation_lock(out_path):
+        catalog.write(out_path)
+    return out_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile catalog csvs into memory-mappable .mcat files')
+    parser.add_argument('csvs', nargs='*', help='csv files to compile (default: every *_playlists/*.csv)')
+    parser.add_argument('--out', default=COMPILED_DIR, help='output directory')
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    csvs = args.csvs or list_catalog_files(here, '.csv')
+    failed = 0
+    for csv_path in csvs:
+        try:
+            out_path = compile_csv(csv_path, args.out)
+            print(f"{csv_path} -> {out_path}")
+        except Exception as e:
+            failed += 1
+            print(f"Failed to compile {csv_path}: {e}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
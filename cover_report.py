@@ -0,0 +1,61 @@
+import argparse
+import csv
+import os
+import sys
+
+from catalog_indexes import normalize_artist, normalize_title
+from catalog_store import CompiledCatalog
+
+"""
+Every song title in a catalog recorded by more than one artist (covers), in one pass over the rows.
+
+    python cover_report.py                                   # S_playlists/Master_Catalog.csv
+    python cover_report.py C_playlists/Master_Catalog.csv -o covers.csv
+"""
+
+
+# {normalized title: {primary artist: [(artist(s), track name, track id), ...]}} for titles with 2+ artists
+def cover_clusters(catalog, min_artists=2):
+    clusters = {}
+    for i in range(len(catalog)):
+        artists = catalog.artists[i]
+        primary = normalize_artist(artists.split(',')[0])
+        name = catalog.track_names[i]
+        clusters.setdefault(normalize_title(name), {}).setdefault(primary, []).append((artists, name, catalog.track_id(i)))
+    return {title: by_artist for title, by_artist in clusters.items() if title and len(by_artist) >= min_artists}
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Report song titles recorded by more than one artist')
+    parser.add_argument('catalog', nargs='?', default=os.path.join(here, 'S_playlists', 'Master_Catalog.csv'),
+                        help='catalog csv or compiled .mcat file')
+    parser.add_argument('-o', '--output', help='write the report here as csv (default: stdout)')
+    parser.add_argument('--min-artists', type=int, default=2, help='smallest number of artists that counts as a cluster')
+    args = parser.parse_args(argv)
+
+    if args.catalog.endswith('.mcat'):
+        catalog = CompiledCatalog.open(args.catalog)
+    else:
+        catalog = CompiledCatalog.from_csv(args.catalog)
+    clusters = cover_clusters(catalog, min_artists=args.min_artists)
+
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(['Title', 'Artists In Cluster', 'Artist(s)', 'Track Name', 'Track ID'])
+        # biggest clusters first
+        for title, by_artist in sorted(clusters.items(), key=lambda item: (-len(item[1]), item[0])):
+            for recordings in by_artist.values():
+                for artists, name, track_id in recordings:
+                    writer.writerow([title, len(by_artist), artists, name, track_id])
+    finally:
+        if args.output:
+            out.close()
+
+    print(f"{len(clusters)} titles recorded by {args.min_artists}+ artists", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
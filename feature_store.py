@@ -0,0 +1,213 @@
+import numpy as np
+import threading
+import logging
+import time
+import os
+
+from similarity import AUDIO_FEATURE_KEYS, FEATURE_COLUMNS
+from catalog_store import COMPILED_DIR, FORMAT_VERSION, CompiledCatalog, generation_lock, list_catalog_files, map_arrays, write_arrays
+
+"""
+Audio features by track id, straight from our own catalogs instead of sp.audio_features (which spotify took away).
+
+Master_Catalog.csv and every playlist csv in S_playlists/ and C_playlists/ get merged into one float32 matrix
+with its rows sorted by track id, so a lookup is a binary search (np.searchsorted, a whole batch at once) and
+never touches the network. A track is kept from the first catalog that has ratings for it (the Master catalogs
+go first). Compiled .mcat files are used when they're newer than the csv. Ids we don't have get appended to
+FEATURE_MISS_QUEUE (one per line) so they can be backfilled later.
+
+The merged matrix is written to FEATURE_STORE_PATH and mapped read only, so with several gunicorn workers the
+first one to load builds it and the others just map the same file (it's rebuilt when a source csv changes).
+"""
+
+LOCAL_CATALOG_DIR = os.environ.get('LOCAL_CATALOG_DIR', os.path.dirname(os.path.abspath(__file__)))
+FEATURE_MISS_QUEUE = os.environ.get('FEATURE_MISS_QUEUE', os.path.join(LOCAL_CATALOG_DIR, 'feature_misses.txt'))
+FEATURE_STORE_PATH = os.environ.get('FEATURE_STORE_PATH', os.path.join(COMPILED_DIR, 'feature_store.mcat'))
+
+
+# Master catalogs first so their ratings win, then every playlist csv
+def catalog_paths(root=LOCAL_CATALOG_DIR):
+    paths = list_catalog_files(root, '.csv')
+    masters = [os.path.join(root, 'Master_Catalog.csv')] + [p for p in paths if os.path.basename(p) == 'Master_Catalog.csv']
+    return [p for p in masters if os.path.exists(p)] + [p for p in paths if p not in masters]
+
+
+# The compiled copy of csv_path if it's up to date, otherwise the csv parsed
+def open_catalog(csv_path, compiled_dir=COMPILED_DIR):
+    folder = os.path.basename(os.path.dirname(csv_path))
+    name = os.path.basename(csv_path)[:-len('.csv')]
+    mapped = os.path.join(compiled_dir, folder, f"{name}.mcat")
+    if os.path.exists(mapped) and os.path.getmtime(mapped) >= os.path.getmtime(csv_path):
+        try:
+            return CompiledCatalog.open(mapped)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Couldn't map {mapped} ({e}), parsing the csv")
+    return CompiledCatalog.from_csv(csv_path)
+
+
+class FeatureStore:
+
+    def __init__(self, paths=None, miss_queue=FEATURE_MISS_QUEUE, shared_path=FEATURE_STORE_PATH):
+        self.paths = paths
+        self.miss_queue = miss_queue
+        self.shared_path = shared_path
+        # sorted track ids, features[i] belongs to track_ids[i]
+        self.track_ids = np.array([], dtype='S22')
+        self.features = np.empty((0, len(FEATURE_COLUMNS)), dtype=np.float32)
+        self.hits = 0
+        self.misses = 0
+        self.load_seconds = 0.0
+        self.source = None
+        self._buffer = None  # keeps the mmap alive
+        self._loaded = False
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    # Map the shared matrix, or merge every catalog if it's missing or out of date (done on first use, call it
+    # at startup to pay for it up front)
+    def load(self):
+        with self._lock:
+            if self._loaded:
+                return self
+            start = time.perf_counter()
+            paths = self.paths if self.paths is not None else catalog_paths()
+            sources = [[path, *_signature(path)] for path in paths]
+            with generation_lock(self.shared_path):
+                if not self._map(sources):
+                    self._merge(sources)
+            if self.miss_queue and os.path.exists(self.miss_queue):
+                with open(self.miss_queue, encoding='utf-8') as f:
+                    self._queued = {line.strip() for line in f if line.strip()}
+            self.load_seconds = time.perf_counter() - start
+            self._loaded = True
+            logging.debug(f"Feature store: {len(self.track_ids)} tracks ({self.source}) in {self.load_seconds:.2f}s")
+        return self
+
+    # Use the shared file if it was built from exactly these sources
+    def _map(self, sources):
+        if not self.shared_path or not os.path.exists(self.shared_path):
+            return False
+        try:
+            arrays, header, buffer = map_arrays(self.shared_path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring {self.shared_path}: {e}")
+            return False
+        if header.get('sources') != sources:
+            return False
+        self.track_ids, self.features, self._buffer = arrays['track_id'], arrays['features'], buffer
+        self.source = 'shared'
+        return True
+
+    def _merge(self, sources):
+        index = {}
+        blocks = []
+        for path, _, _ in sources:
+            try:
+                blocks.append(self._new_rows(open_catalog(path), index))
+            except Exception as e:
+                logging.warning(f"Skipping {path} in the feature store: {e}")
+        track_ids = np.array([t.encode('utf-8') for t in index], dtype=bytes) if index else self.track_ids
+        order = np.argsort(track_ids, kind='stable')
+        self.track_ids = track_ids[order]
+        if blocks:
+            self.features = np.concatenate(blocks)[order]
+        self.source = 'built'
+
+        if self.shared_path:
+            try:
+                write_arrays(self.shared_path, {'features': self.features, 'track_id': self.track_ids},
+                             {'version': FORMAT_VERSION, 'sources': sources})
+                # drop the private copy for the mapped one, same pages as every other worker
+                self._map(sources)
+            except OSError as e:
+                logging.warning(f"Couldn't write {self.shared_path}, keeping the feature store private: {e}")
+
+    # Features of catalog's rated tracks not in index yet (they get the next rows of the matrix)
+    @staticmethod
+    def _new_rows(catalog, index):
+        rows = []
+        for i in np.flatnonzero(catalog.valid):
+            track_id = _bare_id(catalog.track_id(i))
+            if track_id not in index:
+                index[track_id] = len(index)
+                rows.append(i)
+        return catalog.features[np.array(rows, dtype=np.intp)]
+
+    # Matrix row of every id (binary search over the sorted ids), and whether it was there at all
+    def _rows(self, track_ids):
+        if not track_ids or not len(self.track_ids):
+            return np.zeros(len(track_ids), dtype=np.intp), np.zeros(len(track_ids), dtype=bool)
+        wanted = np.array([t.encode('utf-8') for t in track_ids], dtype=bytes)
+        rows = np.minimum(np.searchsorted(self.track_ids, wanted), len(self.track_ids) - 1)
+        return rows, self.track_ids[rows] == wanted
+
+    def __len__(self):
+        return len(self.load().track_ids)
+
+    def __contains__(self, track_id):
+        return bool(self.load()._rows([_bare_id(track_id)])[1][0])
+
+    # Seed vector (FEATURE_COLUMNS order) for one track, None if we don't have it
+    def seed(self, track_id):
+        features, found = self.resolve([track_id])
+        return features[0] if found[0] else None
+
+    # Same thing shaped like spotify's audio_features response
+    def audio_features(self, track_id):
+        seed = self.seed(track_id)
+        if seed is None:
+            return None
+        return {key: (None if np.isnan(value) else float(value)) for key, value in zip(AUDIO_FEATURE_KEYS, seed)}
+
+    # (features, found) for a batch of ids, rows we don't have are NaN and get queued for backfill unless record_misses
+    # is False (lookups over someone else's playlist shouldn't flood the queue)
+    def resolve(self, track_ids, record_misses=True):
+        self.load()
+        track_ids = [_bare_id(t) for t in track_ids]
+        rows, found = self._rows(track_ids)
+        features = np.full((len(track_ids), self.features.shape[1]), np.nan, dtype=np.float32)
+        features[found] = self.features[rows[found]]
+
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        if record_misses and not found.all():
+            self._queue_misses([t for t, ok in zip(track_ids, found) if not ok])
+        return features, found
+
+    def _queue_misses(self, track_ids):
+        with self._lock:
+            new = [t for t in dict.fromkeys(track_ids) if t and t not in self._queued]
+            if not new:
+                return
+            self._queued.update(new)
+            if self.miss_queue:
+                try:
+                    with open(self.miss_queue, 'a', encoding='utf-8') as f:
+                        f.writelines(f"{t}\n" for t in new)
+                except OSError as e:
+                    logging.warning(f"Couldn't record feature misses: {e}")
+        logging.debug(f"No features for {len(new)} track(s), queued for backfill")
+
+    def stats(self):
+        return {
+            'tracks': len(self.track_ids),
+            'hits': self.hits,
+            'misses': self.misses,
+            'queued': len(self._queued),
+            'load_seconds': round(self.load_seconds, 3),
+            'shared': self._buffer is not None,
+        }
+
+
+# spotify:track:<id> -> <id>
+def _bare_id(track_id):
+    return str(track_id).rsplit(':', 1)[-1]
+
+
+# (size, mtime in ns) of a source csv, what the shared matrix remembers to know when it's out of date
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return [0, 0]
+    return [stat.st_size, stat.st_mtime_ns]
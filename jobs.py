@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import threading
+import sqlite3
+import logging
+import json
+import time
+import os
+
+"""
+Background jobs for the slow buttons (building + syncing a big playlist can take longer than a gateway waits).
+
+    job, coalesced = jobs.submit(user_id, 'artist_playlist', 'the beatles', build, sp, master, ...)
+    jobs.get(job['id'])  # {'status': 'running', 'stage': 'Syncing playlist', 'progress': 0.4, ...}
+
+The job runs on this worker's thread pool, fn gets a JobProgress as its first argument to report what
+it's doing and its return value becomes the job's message. Job state lives in SQLite (like the tokens), so a
+status poll can land on any gunicorn worker. A user can only have JOBS_PER_USER jobs queued or running, and
+submitting the same kind + key again while one is still going just hands back that job (checked inside one
+SQLite write transaction, with a unique index on the active jobs behind it, so it holds across workers too). Finished jobs are kept JOB_TTL seconds for
+polling. The worker that owns a job writes a heartbeat for it every JOB_STALE / 4 seconds (and on every progress
+update), a job whose heartbeat is older than JOB_STALE seconds (its worker died) is marked failed, however long it
+has been running.
+"""
+
+JOB_DB = os.environ.get('JOB_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOBS_PER_USER = int(os.environ.get('JOBS_PER_USER', 2))
+JOB_TTL = float(os.environ.get('JOB_TTL', 3600))
+JOB_STALE = float(os.environ.get('JOB_STALE', 600))
+ACTIVE = ('queued', 'running')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    job_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    heartbeat REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (user_id, kind, job_key) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, status);
+"""
+
+
+class TooManyJobs(Exception):
+    pass
+
+
+# What a running job uses to say how far along it is
+class JobProgress:
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+
+    def __call__(self, stage, progress=None):
+        if progress is None:
+            self.queue._execute('UPDATE jobs SET stage = ?, heartbeat = ? WHERE id = ?', (stage, time.time(), self.job_id))
+        else:
+            self.queue._execute('UPDATE jobs SET stage = ?, progress = ?, heartbeat = ? WHERE id = ?',
+                                (stage, progress, time.time(), self.job_id))
+
+
+class JobQueue:
+
+    def __init__(self, db_path=JOB_DB, workers=JOB_WORKERS, per_user=JOBS_PER_USER, ttl=JOB_TTL, stale=JOB_STALE):
+        self.db_path = db_path
+        self.per_user = per_user
+        self.ttl = ttl
+        self.stale = stale
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.failed = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._done = {}  # job id -> Event, for jobs started by this process
+        self._lock = threading.Lock()
+        self._heart = None
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+            # jobs.db files from before the heartbeat column
+            if 'heartbeat' not in {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}:
+                db.execute('ALTER TABLE jobs ADD COLUMN heartbeat REAL')
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=10)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        # job states aren't worth an fsync per progress update
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _execute(self, sql, params=()):
+        db = self._connect()
+        try:
+            with db:
+                return db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+
+    # Queue fn(progress, *args, **kwargs) for user_id, returns (job dict, coalesced), raises TooManyJobs
+    def submit(self, user_id, kind, key, fn, *args, **kwargs):
+        now = time.time()
+        job_id = uuid4().hex
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            self._expire(db, now)
+            existing = db.execute('SELECT * FROM jobs WHERE user_id = ? AND kind = ? AND job_key = ? AND status IN (?, ?)',
+                                  (user_id, kind, key, *ACTIVE)).fetchone()
+            if existing is not None:
+                db.rollback()
+                self.coalesced += 1
+                return self._public(existing), True
+            active = db.execute('SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN (?, ?)',
+                                (user_id, *ACTIVE)).fetchone()[0]
+            if active >= self.per_user:
+                db.rollback()
+                self.rejected += 1
+                raise TooManyJobs(f"Already {active} jobs running, wait for one to finish.")
+            db.execute('INSERT INTO jobs (id, user_id, kind, job_key, status, stage, created, heartbeat) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (job_id, user_id, kind, key, 'queued', 'Queued', now, now))
+            db.commit()
+        finally:
+            db.close()
+
+        with self._lock:
+            self._done[job_id] = threading.Event()
+        self.submitted += 1
+        self._start_heart()
+        self._pool.submit(self._run, job_id, fn, args, kwargs)
+        return self.get(job_id), False
+
+    def _run(self, job_id, fn, args, kwargs):
+        now = time.time()
+        self._execute("UPDATE jobs SET status = 'running', started = ?, heartbeat = ? WHERE id = ?", (now, now, job_id))
+        try:
+            message = fn(JobProgress(self, job_id), *args, **kwargs)
+            self._execute("UPDATE jobs SET status = 'done', stage = 'Done', progress = 1, message = ?, finished = ? "
+                          "WHERE id = ?", (json.dumps(message), time.time(), job_id))
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Job {job_id} failed: {e}")
+            self._execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+                          (str(e) or type(e).__name__, time.time(), job_id))
+        finally:
+            with self._lock:
+                done = self._done.pop(job_id, None)
+            if done is not None:
+                done.set()
+
+    # Keep the heartbeat of every job this process has queued or running fresh, so _expire leaves them alone
+    def _start_heart(self):
+        with self._lock:
+            if self._heart is None:
+                self._heart = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+                self._heart.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.stale / 4)
+            with self._lock:
+                job_ids = list(self._done)
+            if not job_ids:
+                continue
+            try:
+                self._execute(f"UPDATE jobs SET heartbeat = ? WHERE id IN ({', '.join('?' * len(job_ids))}) "
+                              "AND status IN (?, ?)", (time.time(), *job_ids, *ACTIVE))
+            except sqlite3.Error as e:
+                logging.warning(f"Job heartbeat failed: {e}")
+
+    # Drop old finished jobs, fail the ones whose worker went away (no heartbeat for stale seconds)
+    def _expire(self, db, now):
+        db.execute('DELETE FROM jobs WHERE finished < ?', (now - self.ttl,))
+        db.execute("UPDATE jobs SET status = 'failed', error = 'Job was lost (server restarted?)', finished = ? "
+                   "WHERE status IN (?, ?) AND COALESCE(heartbeat, started, created) < ?", (now, *ACTIVE, now - self.stale))
+
+    @staticmethod
+    def _public(row):
+        job = {k: row[k] for k in ('id', 'kind', 'status', 'stage', 'error')}
+        job['progress'] = round(row['progress'], 3)
+        job['message'] = json.loads(row['message']) if row['message'] else None
+        end = row['finished'] or time.time()
+        job['seconds'] = round(end - (row['started'] or row['created']), 3) if row['status'] != 'queued' else 0.0
+        return job
+
+    # The job's status, None if there's no such job (or it isn't user_id's)
+    def get(self, job_id, user_id=None):
+        rows = self._execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        if not rows or (user_id is not None and rows[0]['user_id'] != user_id):
+            return None
+        return self._public(rows[0])
+
+    # Block until a job this process started is finished (tests / benchmark.py), returns its status
+    def wait(self, job_id, timeout=None):
+        with self._lock:
+            done = self._done.get(job_id)
+        if done is not None:
+            done.wait(timeout)
+        return self.get(job_id)
+
+    def stats(self):
+        rows = self._execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')
+        stats = {f"jobs_{row['status']}": row['n'] for row in rows}
+        stats.update(submitted=self.submitted, coalesced=self.coalesced, rejected=self.rejected, failed=self.failed)
+        return stats
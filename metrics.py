@@ -0,0 +1,202 @@
+from contextlib import contextmanager
+from bisect import bisect_left
+import threading
+import logging
+import time
+import re
+import os
+
+"""
+Timing spans, counters and histograms for the hot paths, rendered as Prometheus text for /metrics.
+
+    with span('catalog'):
+        catalog = catalog_cache.get(...)
+
+Every span feeds the stage_seconds histogram. While a request is being handled (begin_request() was called
+on this thread) its spans are also kept in a list, so they can go out in a Server-Timing header
+(SERVER_TIMING=1, or ?timing=1 on a single request). Recording is one perf_counter pair, a bisect and a
+locked add, cheap enough to leave on everywhere. Values are per process, each gunicorn worker has its own.
+
+RedactSecrets is a logging filter that blanks tokens, secrets, auth codes and Bearer headers out of every
+log line (ours and spotipy's debug logging, which prints request headers).
+"""
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+PREFIX = 'spotify_app_'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket (+inf last), sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        b = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][b] += 1
+            counts[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{self.name}_bucket{_labels({**labels, 'le': le})} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help):
+        metric = Counter(PREFIX + name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        metric = Histogram(PREFIX + name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    # fn() -> {name: value}, read at scrape time (for things that already keep their own counts)
+    def collect(self, fn, kind='gauge', help=''):
+        self.collectors.append((fn, kind, help))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for fn, kind, help in self.collectors:
+            try:
+                values = fn()
+            except Exception as e:
+                logging.warning(f"Metrics collector failed: {e}")
+                continue
+            for name, value in values.items():
+                # flags (ready, shared, ...) go out as 0 / 1 gauges
+                if isinstance(value, bool):
+                    value = int(value)
+                elif not isinstance(value, (int, float)):
+                    continue
+                name = PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+REQUEST_SECONDS = registry.histogram('request_seconds', 'Time to handle a request, by endpoint')
+STAGE_SECONDS = registry.histogram('stage_seconds', 'Time spent in each stage of a request')
+SPOTIFY_CALLS = registry.counter('spotify_calls_total', 'Calls made to the spotify web api, by method')
+SPOTIFY_CALL_SECONDS = registry.histogram('spotify_call_seconds', 'Spotify web api call latency, by method')
+CATALOG_BYTES = registry.counter('catalog_bytes_fetched_total', 'Bytes of catalog csv downloaded')
+ROWS_SCANNED = registry.counter('rows_scanned_total', 'Catalog rows looked at, by stage')
+
+_local = threading.local()
+
+
+# Start keeping this thread's spans (for a Server-Timing header)
+def begin_request():
+    _local.spans = []
+
+
+# This thread's spans since begin_request(), and stop keeping them
+def end_request():
+    spans = getattr(_local, 'spans', None)
+    _local.spans = None
+    return spans or []
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+# [('catalog', 0.0123), ...] -> 'catalog;dur=12.3, ...'
+def server_timing(spans):
+    return ', '.join(f"{re.sub(r'[^a-zA-Z0-9_-]', '_', stage)};dur={elapsed * 1000:.1f}" for stage, elapsed in spans)
+
+
+_SECRETS = re.compile(r"""(\b(?:access_token|refresh_token|client_secret)['"]?\s*[:=]\s*['"]?)([^'"&\s,}]+)""")
+# the OAuth code as a query param (?code=...) or a quoted string in spotipy's token request body ('code': '...'),
+# not spotify's numeric error codes (code:-1)
+_AUTH_CODE = re.compile(r"""([?&]code=|['"]code['"]\s*:\s*['"])([^'"&\s,}]+)""")
+_BEARER = re.compile(r'(Bearer\s+)[^\s\'",}]+')
+
+
+def redact(text):
+    text = _AUTH_CODE.sub(r'\1[redacted]', _SECRETS.sub(r'\1[redacted]', text))
+    return _BEARER.sub(r'\1[redacted]', text)
+
+
+class RedactSecrets(logging.Filter):
+
+    def filter(self, record):
+        message = record.getMessage()
+        redacted = redact(message)
+        if redacted != message:
+            record.msg = redacted
+            record.args = None
+        return True
+
+
+# Put the redaction filter on every handler of logger (filters on handlers also see records from child loggers)
+def install_redaction(logger=None):
+    logger = logger or logging.getLogger()
+    for handler in logger.handlers:
+        if not any(isinstance(f, RedactSecrets) for f in handler.filters):
+            handler.addFilter(RedactSecrets())
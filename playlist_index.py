@@ -0,0 +1,214 @@
+import numpy as np
+import threading
+import warnings
+import logging
+import json
+import os
+
+from catalog_builder import MASTER_NAME, playlist_name
+from catalog_store import COMPILED_DIR
+from feature_store import LOCAL_CATALOG_DIR, open_catalog
+from playlist_sync import playlist_track_ids
+from similarity import squared_distances
+
+"""
+Documented playlists (the csvs in S_playlists/ C_playlists/) indexed by spotify playlist id, for Catalog=Current.
+
+Every documented playlist is a set of row positions in its user's Master catalog (catalog_builder.py merges
+every playlist into it) plus the centroid and spread of those rows' features. "Songs like this one from the
+playlist I'm playing" is then a nearest neighbour search over Master masked to those rows: no csv to fetch
+and no 404 for a playlist that was never documented. A playlist id is matched to a documented playlist by name
+the first time it shows up (one sp.playlist call, names compared ignoring case and extra whitespace) and the
+id -> name pairs are kept in PLAYLIST_IDS, so after that it's a dict lookup. A playlist that isn't documented
+borrows the documented playlist whose centroid is nearest to the centroid of its own songs (or to the song
+playing, if we have features for none of them). The index is rebuilt when the Master catalog changes.
+"""
+
+PLAYLIST_IDS = os.environ.get('PLAYLIST_IDS', os.path.join(COMPILED_DIR, 'playlist_ids.json'))
+
+
+# "Blue wop " / "blue  WOP" -> "blue wop"
+def normalize_playlist(name):
+    return ' '.join(str(name).split()).casefold()
+
+
+class PlaylistIndex:
+
+    def __init__(self, master, names, rows, starts, centroids, spreads):
+        self.master = master
+        # playlist p is names[p], its Master rows are rows[starts[p]:starts[p + 1]]
+        self.names = names
+        self.rows = rows
+        self.starts = starts
+        # (playlists, 10) feature means, NaN for playlists with no rated songs in Master
+        self.centroids = centroids
+        # RMS distance of a playlist's songs from its centroid, in std units
+        self.spreads = spreads
+        self.weights = (1.0 / master.std).astype(np.float32)
+        self.exact = {name: p for p, name in enumerate(names)}
+        self.normalized = {}
+        for p, name in enumerate(names):
+            self.normalized.setdefault(normalize_playlist(name), p)
+
+    # Index every documented playlist csv in folder against master (a CatalogEntry)
+    @classmethod
+    def build(cls, master, folder):
+        names = sorted(playlist_name(f) for f in os.listdir(folder) if f.lower().endswith('.csv')) if os.path.isdir(folder) else []
+        names = [name for name in names if name != MASTER_NAME]
+        sorted_ids = master.track_ids[master.id_order]
+
+        all_rows, counts = [], []
+        centroids = np.full((len(names), master.features.shape[1]), np.nan, dtype=np.float32)
+        spreads = np.full(len(names), np.nan, dtype=np.float32)
+        weights = (1.0 / master.std).astype(np.float32)
+        for p, name in enumerate(names):
+            try:
+                track_ids = open_catalog(os.path.join(folder, f"{name}.csv")).track_ids
+            except Exception as e:
+                logging.warning(f"Skipping {name} in the playlist index: {e}")
+                track_ids = np.array([], dtype='S22')
+            rows = _rows_in(master, sorted_ids, track_ids)
+            all_rows.append(rows)
+            counts.append(len(rows))
+
+            rated = master.features[rows[master.valid[rows]]]
+            if len(rated):
+                # each feature over the songs that have it, NaN if none of them do
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    centroids[p] = np.nanmean(rated, axis=0)
+                spreads[p] = np.sqrt(squared_distances((rated - centroids[p]) * weights).mean())
+
+        starts = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(counts, out=starts[1:])
+        rows = np.concatenate(all_rows) if all_rows else np.array([], dtype=np.int32)
+        return cls(master, names, rows, starts, centroids, spreads)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Position of a documented playlist by its spotify display name, None if there's no csv for it
+    def find(self, name):
+        p = self.exact.get(name)
+        return p if p is not None else self.normalized.get(normalize_playlist(name))
+
+    def playlist_rows(self, p):
+        return self.rows[self.starts[p]:self.starts[p + 1]]
+
+    # Boolean mask over Master of playlist p's songs (the candidates for a masked search)
+    def mask(self, p):
+        mask = np.zeros(len(self.master), dtype=bool)
+        mask[self.playlist_rows(p)] = True
+        return mask
+
+    # Documented playlist whose centroid is closest to point (in std units), None if none of them have one
+    def nearest(self, point):
+        if point is None or not len(self.names):
+            return None
+        point = np.asarray(point, dtype=np.float32)
+        dims = ~np.isnan(point)
+        diff = (self.centroids[:, dims] - point[dims]) * self.weights[dims]
+        dist = np.sqrt(squared_distances(diff))
+        dist[np.isnan(dist)] = np.inf
+        p = int(np.argmin(dist))
+        return p if np.isfinite(dist[p]) else None
+
+    def describe(self, p):
+        return {'name': self.names[p], 'songs': int(self.starts[p + 1] - self.starts[p]),
+                'centroid': [None if np.isnan(v) else round(float(v), 4) for v in self.centroids[p]],
+                'spread': None if np.isnan(self.spreads[p]) else round(float(self.spreads[p]), 4)}
+
+
+# Master rows of track_ids (binary search over Master's sorted ids), tracks Master doesn't have are left out
+def _rows_in(master, sorted_ids, track_ids):
+    if not len(track_ids) or not len(sorted_ids):
+        return np.array([], dtype=np.int32)
+    at = np.minimum(np.searchsorted(sorted_ids, track_ids), len(sorted_ids) - 1)
+    found = sorted_ids[at] == track_ids
+    return np.unique(master.id_order[at[found]]).astype(np.int32)
+
+
+# One PlaylistIndex per user, plus the playlist id -> name pairs we've learnt from spotify
+class PlaylistIndexes:
+
+    def __init__(self, feature_store, local_dir=LOCAL_CATALOG_DIR, ids_path=PLAYLIST_IDS):
+        self.feature_store = feature_store
+        self.local_dir = local_dir
+        self.ids_path = ids_path
+        self._indexes = {}
+        # (user_abbrev, playlist id) -> documented playlist it borrowed, for undocumented playlists
+        self._borrowed = {}
+        self._names = self._read_names()
+        self._lock = threading.Lock()
+
+    def _read_names(self):
+        if not self.ids_path or not os.path.exists(self.ids_path):
+            return {}
+        try:
+            with open(self.ids_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring {self.ids_path}: {e}")
+            return {}
+
+    # The user's index, (re)built if Master changed since it was made
+    def get(self, user_abbrev, master):
+        with self._lock:
+            index = self._indexes.get(user_abbrev)
+        if index is not None and index.master is master:
+            return index
+        folder = os.path.join(self.local_dir, f"{user_abbrev}_playlists")
+        index = PlaylistIndex.build(master, folder)
+        with self._lock:
+            self._indexes[user_abbrev] = index
+            self._borrowed = {key: p for key, p in self._borrowed.items() if key[0] != user_abbrev}
+        logging.debug(f"Indexed {len(index)} {user_abbrev} playlists")
+        return index
+
+    # Display name of a spotify playlist, asked for once per id
+    def playlist_name(self, sp, playlist_id):
+        name = self._names.get(playlist_id)
+        if name is not None:
+            return name
+        name = sp.playlist(playlist_id, fields='name')['name']
+        with self._lock:
+            self._names[playlist_id] = name
+            if self.ids_path:
+                # other workers may have learnt some too
+                names = dict(self._read_names(), **self._names)
+                try:
+                    tmp_path = f"{self.ids_path}.{os.getpid()}.tmp"
+                    os.makedirs(os.path.dirname(os.path.abspath(self.ids_path)), exist_ok=True)
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(names, f, ensure_ascii=False)
+                    os.replace(tmp_path, self.ids_path)
+                except OSError as e:
+                    logging.warning(f"Couldn't save playlist ids: {e}")
+        return name
+
+    # (index, documented playlist, 'documented' / 'nearest') for a spotify playlist id, None if nothing fits
+    def resolve(self, sp, user_abbrev, master, playlist_id, seed=None):
+        index = self.get(user_abbrev, master)
+        p = index.find(self.playlist_name(sp, playlist_id))
+        if p is not None:
+            return index, p, 'documented'
+
+        key = (user_abbrev, playlist_id)
+        with self._lock:
+            p = self._borrowed.get(key)
+        if p is None:
+            p = index.nearest(self.centroid(sp, playlist_id, seed))
+            if p is None:
+                return None
+            with self._lock:
+                self._borrowed[key] = p
+        return index, p, 'nearest'
+
+    # Feature centroid of a spotify playlist's songs we have features for, seed if we have none (the ones we
+    # don't have aren't queued for backfill, it's not our playlist)
+    def centroid(self, sp, playlist_id, seed=None):
+        track_ids = [t for t in playlist_track_ids(sp, playlist_id) if t]
+        features, found = self.feature_store.resolve(track_ids, record_misses=False)
+        if found.any():
+            return features[found].mean(axis=0)
+        return seed
@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from spotipy.exceptions import SpotifyException
+import threading
+import logging
+import time
+import os
+
+"""
+Sync a named playlist to a list of tracks instead of deleting and recreating it.
+
+The existing playlist (found by paging through all of the user's playlists, not just the first 50) is
+diffed against the tracks we want: tracks that shouldn't be there are removed, missing ones are added,
+and if the order matters the kept tracks are moved with the fewest reorder calls (everything outside the
+longest run already in the right order). If the diff would take more calls than rewriting the playlist,
+it's rewritten in place with replace + add. Either way the playlist id (and its followers) stay the same.
+
+Every write goes through a token bucket shared by the whole process, a 429 pauses the bucket for the
+Retry-After spotify sends back. Removals don't care about order so they go out a few at a time in
+parallel, adds have to land in order so they're sent one after another.
+"""
+
+CHUNK_SIZE = 100
+SPOTIFY_RATE_LIMIT = float(os.environ.get('SPOTIFY_RATE_LIMIT', 10))  # calls per second
+SPOTIFY_MAX_PARALLEL = int(os.environ.get('SPOTIFY_MAX_PARALLEL', 4))
+
+
+class TokenBucket:
+
+    def __init__(self, rate=SPOTIFY_RATE_LIMIT, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # Block until a call is allowed
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Stop everyone for a while (spotify's Retry-After)
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+spotify_limiter = TokenBucket()
+
+
+# Call fn through the limiter, waiting out 429s and retrying 5xx with backoff
+def limited_call(fn, *args, limiter=None, attempts=5, **kwargs):
+    limiter = limiter or spotify_limiter
+    for attempt in range(attempts):
+        limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except SpotifyException as e:
+            if attempt == attempts - 1:
+                raise
+            if e.http_status == 429:
+                retry_after = float((e.headers or {}).get('Retry-After', 1))
+                logging.warning(f"Spotify rate limited us, waiting {retry_after}s")
+                limiter.pause(retry_after)
+            elif e.http_status and e.http_status >= 500:
+                time.sleep(0.5 * 2 ** attempt)
+            else:
+                raise
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# The user's own playlist called name, paging through every playlist they have
+def find_playlist(sp, name, user_id, limiter=None):
+    offset = 0
+    while True:
+        page = limited_call(sp.current_user_playlists, limit=50, offset=offset, limiter=limiter)
+        for playlist in page['items']:
+            if playlist and playlist['name'] == name and playlist.get('owner', {}).get('id', user_id) == user_id:
+                return playlist
+        if not page.get('next'):
+            return None
+        offset += len(page['items'])
+
+
+# Track ids in the playlist in order (None for local files / unavailable tracks)
+def playlist_track_ids(sp, playlist_id, limiter=None):
+    track_ids = []
+    offset = 0
+    while True:
+        page = limited_call(sp.playlist_items, playlist_id, fields='items(track(id)),next', limit=100,
+                            offset=offset, additional_types=('track',), limiter=limiter)
+        track_ids += [(item.get('track') or {}).get('id') for item in page['items']]
+        if not page.get('next'):
+            return track_ids
+        offset += len(page['items'])
+
+
+# Indices (into sequence) of one longest strictly increasing run, O(n log n)
+def _longest_increasing(sequence):
+    tails, tail_index, previous = [], [], [-1] * len(sequence)
+    for i, value in enumerate(sequence):
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_index.append(i)
+        else:
+            tails[k] = value
+            tail_index[k] = i
+        previous[i] = tail_index[k - 1] if k > 0 else -1
+    run = []
+    i = tail_index[-1] if tail_index else -1
+    while i != -1:
+        run.append(i)
+        i = previous[i]
+    return set(run)
+
+
+# (range_start, insert_before) moves that turn current into the order of target (same items, no dups)
+def reorder_moves(current, target):
+    rank = {track_id: i for i, track_id in enumerate(target)}
+    stay = {current[i] for i in _longest_increasing([rank[t] for t in current])}
+
+    moves = []
+    current = list(current)
+    for k, track_id in enumerate(target):
+        if track_id in stay:
+            continue
+        # put it right after the one before it in target (already in place, we go in target order)
+        start = current.index(track_id)
+        insert_before = current.index(target[k - 1]) + 1 if k > 0 else 0
+        moves.append((start, insert_before))
+        current.pop(start)
+        current.insert(insert_before if insert_before < start else insert_before - 1, track_id)
+        stay.add(track_id)
+    return moves
+
+
+# Runs of new tracks with the position they go in, once the kept tracks are in target order
+def insert_runs(target, new_ids):
+    runs = []
+    for position, track_id in enumerate(target):
+        if track_id in new_ids and runs and runs[-1][0] + len(runs[-1][1]) == position and len(runs[-1][1]) < CHUNK_SIZE:
+            runs[-1][1].append(track_id)
+        elif track_id in new_ids:
+            runs.append((position, [track_id]))
+    return runs
+
+
+# Make the playlist called name hold exactly track_ids, returns (playlist, {operation: calls})
+def sync_playlist(sp, name, track_ids, description=None, keep_order=True, public=True, limiter=None):
+    track_ids = list(dict.fromkeys(track_ids))
+    user_id = limited_call(sp.current_user, limiter=limiter)['id']
+    ops = {'removed': 0, 'added': 0, 'moved': 0, 'calls': 0}
+
+    playlist = find_playlist(sp, name, user_id, limiter=limiter)
+    if playlist is None:
+        playlist = limited_call(sp.user_playlist_create, user=user_id, name=name, description=description,
+                                public=public, limiter=limiter)
+        _append(sp, playlist['id'], track_ids, ops, limiter)
+        return playlist, ops
+
+    if description is not None and playlist.get('description') != description:
+        limited_call(sp.playlist_change_details, playlist['id'], description=description, limiter=limiter)
+        ops['calls'] += 1
+
+    existing = playlist_track_ids(sp, playlist['id'], limiter=limiter)
+    wanted = set(track_ids)
+    kept = [t for t in existing if t in wanted]
+    kept_set = set(kept)
+    to_remove = list({t for t in existing if t is not None and t not in wanted})
+    new_ids = [t for t in track_ids if t not in kept_set]
+
+    # duplicates or local files in the playlist can't be diffed by id, just rewrite it
+    rewrite = len(kept) != len(kept_set) or None in existing
+    moves, runs = [], []
+    if not rewrite and keep_order:
+        moves = reorder_moves(kept, [t for t in track_ids if t in kept_set])
+        runs = insert_runs(track_ids, set(new_ids))
+    diff_calls = len(_chunks(to_remove)) + len(moves) + (len(runs) if keep_order else len(_chunks(new_ids)))
+    if rewrite or diff_calls > len(_chunks(track_ids)) + 1:
+        logging.debug(f"Rewriting {name}: {diff_calls} diff calls vs {len(_chunks(track_ids)) + 1} to rewrite")
+        _rewrite(sp, playlist['id'], track_ids, ops, limiter)
+        return playlist, ops
+
+    # removals can go out in parallel
+    with ThreadPoolExecutor(max_workers=SPOTIFY_MAX_PARALLEL) as pool:
+        list(pool.map(lambda chunk: limited_call(sp.playlist_remove_all_occurrences_of_items, playlist['id'], chunk,
+                                                 limiter=limiter), _chunks(to_remove)))
+    ops['removed'] += len(to_remove)
+    ops['calls'] += len(_chunks(to_remove))
+
+    if keep_order:
+        for range_start, insert_before in moves:
+            limited_call(sp.playlist_reorder_items, playlist['id'], range_start=range_start,
+                         insert_before=insert_before, limiter=limiter)
+        ops['moved'] += len(moves)
+        ops['calls'] += len(moves)
+        for position, chunk in runs:
+            limited_call(sp.playlist_add_items, playlist['id'], chunk, position=position, limiter=limiter)
+            ops['added'] += len(chunk)
+            ops['calls'] += 1
+    else:
+        _append(sp, playlist['id'], new_ids, ops, limiter)
+    logging.debug(f"Synced {name}: {ops}")
+    return playlist, ops
+
+
+def _append(sp, playlist_id, track_ids, ops, limiter):
+    for chunk in _chunks(track_ids):
+        limited_call(sp.playlist_add_items, playlist_id, chunk, limiter=limiter)
+        ops['added'] += len(chunk)
+        ops['calls'] += 1
+
+
+def _rewrite(sp, playlist_id, track_ids, ops, limiter):
+    chunks = _chunks(track_ids) or [[]]
+    limited_call(sp.playlist_replace_items, playlist_id, chunks[0], limiter=limiter)
+    ops['added'] += len(chunks[0])
+    ops['calls'] += 1
+    _append(sp, playlist_id, [t for chunk in chunks[1:] for t in chunk], ops, limiter)
@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+
+"""
+Similarity engine for the catalogs.
+
+One float32 feature matrix is built per catalog from the ten "... Rating" columns and every query is a
+single batched distance computation + argpartition top-k. A rating missing from the seed is left out of
+every distance, one missing from a row (some playlist csvs have no Loudness at all) is left out of that
+row's distance, which is scaled up to the seed's number of features so it stays comparable. Only rows
+with no ratings at all are masked out.
+
+Distances are plain Euclidean by default (same ranking as the old iterrows loop), pass scale='standard'
+to divide every feature by its std so tempo and loudness stop drowning out everything else, or pass
+your own weights (dict of column -> weight, or a list of 10 numbers).
+"""
+
+# Catalog columns used for similarity, in the same order as the spotify audio feature keys below
+FEATURE_COLUMNS = [
+    'Danceability Rating', 'Energy Rating', 'Loudness Rating', 'Mode Rating',
+    'Speechiness Rating', 'Acousticness Rating', 'Instrumentalness Rating',
+    'Liveness Rating', 'Valence Rating', 'Tempo Rating'
+]
+
+AUDIO_FEATURE_KEYS = [
+    'danceability', 'energy', 'loudness', 'mode', 'speechiness',
+    'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo'
+]
+
+# Some playlist csvs use -99 for "no audio features", treat it the same as NaN
+MISSING_RATING = -99
+
+
+# Build the float32 feature matrix from a catalog DataFrame (missing ratings become NaN)
+def feature_matrix(MC):
+    columns = {c.strip(): c for c in MC.columns}
+    features = np.full((len(MC), len(FEATURE_COLUMNS)), np.nan, dtype=np.float32)
+    for j, name in enumerate(FEATURE_COLUMNS):
+        if name in columns:
+            features[:, j] = pd.to_numeric(MC[columns[name]], errors='coerce').to_numpy(dtype=np.float32)
+    features[features == MISSING_RATING] = np.nan
+    return np.ascontiguousarray(features)
+
+
+# Rows that can be compared at all (they have at least one rating)
+def usable_rows(features):
+    return ~np.isnan(features).all(axis=1)
+
+
+# Per-feature mean and std over the usable rows, each feature over the rows that have it
+def feature_stats(features, valid):
+    usable = features[valid].astype(np.float64)
+    present = ~np.isnan(usable)
+    counts = present.sum(axis=0)
+    mean = np.divide(np.where(present, usable, 0.0).sum(axis=0), counts,
+                     out=np.zeros(len(FEATURE_COLUMNS)), where=counts > 0)
+    var = np.divide((np.where(present, usable - mean, 0.0) ** 2).sum(axis=0), counts,
+                    out=np.zeros(len(FEATURE_COLUMNS)), where=counts > 0)
+    std = np.sqrt(var)
+    return mean, np.where(std > 0, std, 1.0)
+
+
+# Squared distances from (rows, dims) differences, NaN where the row is missing that feature. A row missing
+# some is scored on the ones it has, scaled up to all dims, a row missing all of them gets NaN
+def squared_distances(diff):
+    dist = np.einsum('ij,ij->i', diff, diff, dtype=np.float64)
+    partial = np.flatnonzero(np.isnan(dist))
+    if len(partial):
+        rows = diff[partial]
+        present = ~np.isnan(rows)
+        have = present.sum(axis=1)
+        rows = np.where(present, rows, 0)
+        sums = np.einsum('ij,ij->i', rows, rows, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist[partial] = np.where(have > 0, sums * diff.shape[1] / have, np.nan)
+    return dist
+
+
+class SimilarityEngine:
+
+    def __init__(self, features, track_ids, track_names, valid=None, mean=None, std=None):
+        # track_ids can be str objects or interned utf-8 bytes (compiled catalogs), track_names anything indexable
+        self.features = np.ascontiguousarray(features, dtype=np.float32)
+        self.track_ids = track_ids if isinstance(track_ids, np.ndarray) else np.asarray(track_ids, dtype=object)
+        self.track_names = track_names
+
+        # rows with no ratings at all can never be compared, so mask them out once here
+        self.valid = usable_rows(self.features) if valid is None else valid
+
+        # per-feature stats over the usable rows, used for scale='standard'
+        if mean is not None and std is not None:
+            self.mean = np.asarray(mean)
+            self.std = np.asarray(std)
+        else:
+            self.mean, self.std = feature_stats(self.features, self.valid)
+
+    @classmethod
+    def from_frame(cls, MC):
+        columns = {c.strip(): c for c in MC.columns}
+        return cls(
+            feature_matrix(MC),
+            MC[columns['Track ID']].to_numpy(dtype=object),
+            MC[columns['Track Name']].to_numpy(dtype=object)
+        )
+
+    # Engine straight over a CompiledCatalog's (possibly memory mapped) arrays, nothing is copied
+    @classmethod
+    def from_catalog(cls, catalog):
+        return cls(catalog.features, catalog.track_ids, catalog.track_names,
+                   valid=catalog.valid, mean=catalog.mean, std=catalog.std)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @property
+    def nbytes(self):
+        return self.features.nbytes + self.valid.nbytes + self.track_ids.nbytes
+
+    def track_id(self, i):
+        track_id = self.track_ids[i]
+        return track_id.decode('utf-8') if isinstance(track_id, bytes) else track_id
+
+    def track_name(self, i):
+        return self.track_names[i]
+
+    # Turn a spotify audio_features dict into a seed vector (None values become NaN and are ignored)
+    @staticmethod
+    def seed_from_audio_features(audio_features):
+        return np.array([
+            np.nan if audio_features.get(key) is None else audio_features[key]
+            for key in AUDIO_FEATURE_KEYS
+        ], dtype=np.float32)
+
+    # Per-feature weights for a scale option
+    def weights(self, scale=None):
+        if scale is None or (isinstance(scale, str) and scale == 'raw'):
+            return np.ones(len(FEATURE_COLUMNS), dtype=np.float32)
+        if isinstance(scale, str):
+            if scale == 'standard':
+                return (1.0 / self.std).astype(np.float32)
+            raise ValueError(f"Unknown scale: {scale}")
+        if isinstance(scale, dict):
+            return np.array([scale.get(name, 1.0) for name in FEATURE_COLUMNS], dtype=np.float32)
+        weights = np.asarray(scale, dtype=np.float32)
+        if weights.shape != (len(FEATURE_COLUMNS),):
+            raise ValueError(f"Expected {len(FEATURE_COLUMNS)} feature weights, got {weights.shape}")
+        return weights
+
+    # Boolean mask of the rows holding any of the given track ids (one sorted membership pass, not one per id)
+    def rows_for_ids(self, track_ids):
+        if isinstance(track_ids, np.ndarray) and track_ids.dtype.kind == self.track_ids.dtype.kind:
+            wanted = track_ids
+        elif self.track_ids.dtype.kind == 'S':
+            wanted = np.array([t.encode('utf-8') for t in track_ids], dtype=bytes)
+        else:
+            wanted = np.asarray(list(track_ids), dtype=object)
+        if not len(wanted):
+            return np.zeros(len(self), dtype=bool)
+        return np.isin(self.track_ids, wanted)
+
+    # Distance from seed to every row, rows that can't be compared get inf
+    def distances(self, seed, scale=None):
+        seed = np.asarray(seed, dtype=np.float32)
+        weights = self.weights(scale)
+
+        # features the seed doesn't have are left out of the distance
+        dims = ~np.isnan(seed)
+        diff = (self.features[:, dims] - seed[dims]) * weights[dims]
+        dist = np.sqrt(squared_distances(diff))
+        dist[~self.valid | np.isnan(dist)] = np.inf
+        return dist
+
+    # Top n closest rows to seed, returns (row positions, distances) sorted closest first
+    def nearest(self, seed, n=3, exclude_ids=(), scale=None, candidates=None):
+        dist = self.distances(seed, scale=scale)
+        if exclude_ids:
+            dist[self.rows_for_ids(exclude_ids)] = np.inf
+        if candidates is not None:
+            dist[~candidates] = np.inf
+        return self.top_k(dist, n)
+
+    # Partition top-k with ties broken by catalog order (same as a stable sort)
+    @staticmethod
+    def top_k(dist, n):
+        n = min(n, int(np.isfinite(dist).sum()))
+        if n <= 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.float64)
+        if n < len(dist):
+            # every row up to the n-th smallest distance, ties at that distance included (argpartition would
+            # pick among them arbitrarily), so the sort below breaks them by row
+            kth = np.partition(dist, n - 1)[n - 1]
+            rows = np.flatnonzero(dist <= kth)
+        else:
+            rows = np.arange(len(dist))
+        rows = rows[np.lexsort((rows, dist[rows]))][:n]
+        return rows, dist[rows]
+
+    # Walk k steps through feature space, each pick is the closest unused song to the previous pick
+    def chain(self, seed, k=5, exclude_ids=(), scale=None, candidates=None):
+        weights = self.weights(scale)
+        seed = np.asarray(seed, dtype=np.float32)
+
+        # weight the matrix once, every step after that is one pass over it
+        weighted = self.features * weights
+        available = self.valid.copy()
+        if exclude_ids:
+            available &= ~self.rows_for_ids(exclude_ids)
+        if candidates is not None:
+            available &= candidates
+
+        picks = []
+        current = seed * weights
+        for step in range(k):
+            if not available.any():
+                break
+            # the seed or a pick can be missing features too, those are left out like in distances()
+            dims = ~np.isnan(current)
+            diff = weighted - current if dims.all() else weighted[:, dims] - current[dims]
+            dist = squared_distances(diff)
+            dist[~available | np.isnan(dist)] = np.inf
+            pick = int(np.argmin(dist))
+            picks.append(pick)
+
+            # drop the pick (and any duplicate rows of the same track) from the candidates
+            available[self.track_ids == self.track_ids[pick]] = False
+            current = weighted[pick]
+        return np.array(picks, dtype=np.intp)
@@ -0,0 +1,100 @@
+from collections import Counter
+import logging
+import time
+
+from metrics import SPOTIFY_CALLS, SPOTIFY_CALL_SECONDS
+
+"""
+Request scoped wrapper around a spotipy client.
+
+One button press used to ask spotify for the same thing several times (current_playback in both
+make_artist_playlist and artist_cat, sp.track just to build a uri, ...). A RequestSpotify lives for one
+request: it takes one playback snapshot, memoizes track / playlist / user lookups, builds track uris
+locally, and counts every call that actually goes upstream so each endpoint can log its total.
+Anything not wrapped here is passed straight through to spotipy (and counted).
+"""
+
+# Calls after which the playback snapshot is out of date
+PLAYBACK_CHANGING = {'start_playback', 'pause_playback', 'next_track', 'previous_track', 'transfer_playback', 'seek_track'}
+
+
+# spotify:track:<id> without asking spotify
+def track_uri(track_id):
+    return track_id if track_id.startswith('spotify:') else f"spotify:track:{track_id}"
+
+
+class RequestSpotify:
+
+    def __init__(self, sp):
+        self.sp = sp
+        self.calls = Counter()
+        self.saved = 0
+        self._playback = None
+        self._have_playback = False
+        self._memo = {}
+
+    # positional only, spotipy methods take a name= keyword of their own
+    def _call(self, method, /, *args, **kwargs):
+        self.calls[method] += 1
+        SPOTIFY_CALLS.inc(method=method)
+        start = time.perf_counter()
+        try:
+            return getattr(self.sp, method)(*args, **kwargs)
+        finally:
+            SPOTIFY_CALL_SECONDS.observe(time.perf_counter() - start, method=method)
+
+    def _memoized(self, method, key, /, *args, **kwargs):
+        memo_key = (method, key)
+        if memo_key in self._memo:
+            self.saved += 1
+            return self._memo[memo_key]
+        result = self._call(method, *args, **kwargs)
+        self._memo[memo_key] = result
+        return result
+
+    # One playback snapshot per request
+    def current_playback(self):
+        if self._have_playback:
+            self.saved += 1
+            return self._playback
+        self._playback = self._call('current_playback')
+        self._have_playback = True
+        return self._playback
+
+    def current_user(self):
+        return self._memoized('current_user', None)
+
+    def track(self, track_id):
+        return self._memoized('track', track_id, track_id)
+
+    def playlist(self, playlist_id, **kwargs):
+        return self._memoized('playlist', (playlist_id, tuple(sorted(kwargs.items()))), playlist_id, **kwargs)
+
+    def audio_features(self, tracks):
+        tracks = [tracks] if isinstance(tracks, str) else list(tracks)
+        return self._memoized('audio_features', tuple(tracks), tracks)
+
+    @staticmethod
+    def track_uri(track_id):
+        return track_uri(track_id)
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attribute = getattr(self.sp, name)
+        if not callable(attribute):
+            return attribute
+
+        def passthrough(*args, **kwargs):
+            if name in PLAYBACK_CHANGING:
+                self._have_playback = False
+            return self._call(name, *args, **kwargs)
+        return passthrough
+
+    def log(self, endpoint):
+        breakdown = ', '.join(f"{name}={count}" for name, count in sorted(self.calls.items()))
+        logging.info(f"{endpoint}: {self.total_calls} spotify calls ({breakdown or 'none'}), {self.saved} saved")
@@ -0,0 +1,276 @@
+import numpy as np
+import threading
+import hashlib
+import logging
+import time
+import os
+
+from similarity import FEATURE_COLUMNS
+from catalog_store import COMPILED_DIR, FORMAT_VERSION, generation_lock, map_arrays, write_arrays
+from metrics import span
+
+"""
+Listening-taste analytics: per-parameter histograms, a correlation matrix and 2-D density grids of a catalog,
+for plotting my favourite songs' parameters against each other.
+
+    stats = taste_stats.get('S', 'Liked_Songs')
+    stats.to_json(features=['Energy', 'Valence'])
+
+Everything is kept as sums that can be added to and taken away from: bin counts, and for every pair of
+parameters the count, sums, sums of squares and cross products over the rows that have both (so a parameter
+nobody rated doesn't wipe out the other correlations). Building them is one pass over the feature matrix in
+chunks. A new generation of a catalog only costs its new rows: catalog_builder.py keeps Master's rows in order
+and puts new tracks on the end, so if the rows already counted are unchanged (checked with a hash) only the
+rest get binned, and rows whose ratings changed in place are taken out and put back in. The sums are written
+next to the compiled catalog (<name>.stats) so other workers and restarts carry on from them.
+Ratings outside a parameter's RANGES (the -99 / 99 placeholders) count as missing.
+"""
+
+HIST_BINS = 32
+GRID_BINS = 16
+CHUNK_ROWS = 65536
+RANGES = {
+    'Danceability Rating': (0.0, 1.0),
+    'Energy Rating': (0.0, 1.0),
+    'Loudness Rating': (-60.0, 4.0),
+    'Mode Rating': (0.0, 1.0),
+    'Speechiness Rating': (0.0, 1.0),
+    'Acousticness Rating': (0.0, 1.0),
+    'Instrumentalness Rating': (0.0, 1.0),
+    'Liveness Rating': (0.0, 1.0),
+    'Valence Rating': (0.0, 1.0),
+    'Tempo Rating': (0.0, 256.0)
+}
+LOW = np.array([RANGES[c][0] for c in FEATURE_COLUMNS])
+HIGH = np.array([RANGES[c][1] for c in FEATURE_COLUMNS])
+# sums are taken around the middle of each range so the squares of big values (tempo) don't swamp the rest
+CENTRE = (LOW + HIGH) / 2
+PAIRS = [(i, j) for i in range(len(FEATURE_COLUMNS)) for j in range(i + 1, len(FEATURE_COLUMNS))]
+# anything that changes what the sums mean, a saved file with a different layout is rebuilt
+LAYOUT = {'hist_bins': HIST_BINS, 'grid_bins': GRID_BINS, 'ranges': [list(RANGES[c]) for c in FEATURE_COLUMNS]}
+# catalog_digests of no rows
+EMPTY_DIGEST = hashlib.blake2b(digest_size=16).hexdigest() * 2
+
+
+# 'Energy' / 'energy rating' -> position in FEATURE_COLUMNS
+def feature_position(name):
+    wanted = ' '.join(str(name).split()).casefold()
+    for j, column in enumerate(FEATURE_COLUMNS):
+        if wanted in (column.casefold(), column[:-len(' Rating')].casefold()):
+            return j
+    raise ValueError(f"Unknown parameter {name!r}")
+
+
+# Hashes of a catalog's first n rows and of all its rows (ids + ratings), how saved sums know which rows they
+# cover. Every row is hashed once, the full hash carries on from the prefix's
+def catalog_digests(catalog, n):
+    ids, features = hashlib.blake2b(digest_size=16), hashlib.blake2b(digest_size=16)
+    ids.update(np.ascontiguousarray(catalog.track_ids[:n]).tobytes())
+    features.update(np.ascontiguousarray(catalog.features[:n]).tobytes())
+    prefix = ids.hexdigest() + features.hexdigest()
+    ids.update(np.ascontiguousarray(catalog.track_ids[n:]).tobytes())
+    features.update(np.ascontiguousarray(catalog.features[n:]).tobytes())
+    return prefix, ids.hexdigest() + features.hexdigest()
+
+
+# Bin of every value in bins equal bins over its parameter's range, -1 where it's missing
+def _bins(values, present, bins):
+    scaled = (np.where(present, values, LOW) - LOW) / (HIGH - LOW) * bins
+    return np.where(present, np.minimum(scaled.astype(np.int64), bins - 1), -1)
+
+
+def _empty():
+    d = len(FEATURE_COLUMNS)
+    return {
+        'histograms': np.zeros((d, HIST_BINS), dtype=np.int64),
+        'grids': np.zeros((len(PAIRS), GRID_BINS, GRID_BINS), dtype=np.int64),
+        'outside': np.zeros(d, dtype=np.int64),
+        # [i, j] is over the rows where both i and j are rated: count, sum of i, sum of i squared, sum of i * j
+        'pair_count': np.zeros((d, d)),
+        'pair_sums': np.zeros((d, d)),
+        'pair_squares': np.zeros((d, d)),
+        'cross': np.zeros((d, d))
+    }
+
+
+class TasteStats:
+
+    def __init__(self, arrays=None, rows=0, digest=EMPTY_DIGEST):
+        self.arrays = arrays if arrays is not None else _empty()
+        # how many of the catalog's rows are counted, and their hash (catalog_digests)
+        self.rows = rows
+        self.digest = digest
+
+    def copy(self):
+        return TasteStats({name: array.copy() for name, array in self.arrays.items()}, self.rows, self.digest)
+
+    # Count (sign=1) or uncount (sign=-1) rows of features, one pass in CHUNK_ROWS chunks
+    def add(self, features, sign=1):
+        a = self.arrays
+        for start in range(0, len(features), CHUNK_ROWS):
+            chunk = np.array(features[start:start + CHUNK_ROWS], dtype=np.float64)
+            outside = (chunk < LOW) | (chunk > HIGH)
+            a['outside'] += sign * outside.sum(axis=0)
+            present = ~np.isnan(chunk) & ~outside
+
+            values = np.where(present, chunk - CENTRE, 0.0)
+            weights = present.astype(np.float64)
+            a['pair_count'] += sign * (weights.T @ weights)
+            a['pair_sums'] += sign * (values.T @ weights)
+            a['pair_squares'] += sign * ((values ** 2).T @ weights)
+            a['cross'] += sign * (values.T @ values)
+
+            hist = _bins(chunk, present, HIST_BINS)
+            for j in range(hist.shape[1]):
+                a['histograms'][j] += sign * np.bincount(hist[present[:, j], j], minlength=HIST_BINS)
+            grid = _bins(chunk, present, GRID_BINS)
+            for p, (i, j) in enumerate(PAIRS):
+                both = present[:, i] & present[:, j]
+                cells = grid[both, i] * GRID_BINS + grid[both, j]
+                a['grids'][p] += sign * np.bincount(cells, minlength=GRID_BINS * GRID_BINS).reshape(GRID_BINS, GRID_BINS)
+
+    # Bring the sums up to date with catalog, counting as few rows as possible. previous is the catalog they were
+    # last synced to, if we still have it. Returns 'current', 'appended', 'updated' or 'built'
+    def sync(self, catalog, previous=None):
+        n, total = self.rows, len(catalog)
+        prefix, digest = catalog_digests(catalog, min(n, total))
+        if n <= total and self.digest == prefix:
+            how = 'current' if n == total else 'appended' if n else 'built'
+        elif (previous is not None and len(previous) == n <= total
+              and np.array_equal(previous.track_ids, catalog.track_ids[:n])):
+            # same rows in the same order, some of them got (different) ratings
+            old, new = previous.features, catalog.features[:n]
+            changed = np.flatnonzero(((old != new) & ~(np.isnan(old) & np.isnan(new))).any(axis=1))
+            self.add(old[changed], sign=-1)
+            self.add(new[changed])
+            how = 'updated'
+        else:
+            self.arrays, n = _empty(), 0
+            how = 'built'
+        self.add(catalog.features[n:])
+        self.rows, self.digest = total, digest
+        return how
+
+    @classmethod
+    def read(cls, path):
+        arrays, header, _ = map_arrays(path)
+        if header.get('layout') != LAYOUT:
+            raise ValueError(f"{path} was built with different bins")
+        # private copies, they get added to
+        return cls({name: np.array(array) for name, array in arrays.items()}, header['rows'], header['digest'])
+
+    def write(self, path):
+        return write_arrays(path, self.arrays, {'version': FORMAT_VERSION, 'rows': self.rows, 'digest': self.digest,
+                                                'layout': LAYOUT})
+
+    # Compact json for the page: features limits it to some parameters (names or positions), density counts are
+    # row major, counts[p][x * bins + y] is how many songs have pairs[p][0] in bin x and pairs[p][1] in bin y
+    def to_json(self, features=None):
+        a = self.arrays
+        columns = sorted({j if isinstance(j, int) else feature_position(j) for j in features}) if features else \
+            list(range(len(FEATURE_COLUMNS)))
+
+        n, sums, squares = a['pair_count'], a['pair_sums'], a['pair_squares']
+        count = np.diag(n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.diag(sums) / count
+            std = np.sqrt(np.maximum(np.diag(squares) / count - mean ** 2, 0))
+            # pearson r from the sums, over the rows that have both parameters
+            cov = n * a['cross'] - sums * sums.T
+            spread = (n * squares - sums ** 2) * (n * squares.T - sums.T ** 2)
+            corr = cov / np.sqrt(spread)
+        corr[(n < 2) | ~(spread > 0)] = np.nan
+
+        def rounded(values, digits=4):
+            return [None if np.isnan(v) else round(float(v), digits) for v in values]
+
+        pairs = [(p, i, j) for p, (i, j) in enumerate(PAIRS) if i in columns and j in columns]
+        return {
+            'rows': self.rows,
+            'features': [FEATURE_COLUMNS[j][:-len(' Rating')] for j in columns],
+            'summary': {
+                'count': [int(count[j]) for j in columns],
+                'mean': rounded(mean[columns] + CENTRE[columns]),
+                'std': rounded(std[columns]),
+                'outside': [int(a['outside'][j]) for j in columns]
+            },
+            'histograms': {
+                'bins': HIST_BINS,
+                'ranges': [list(RANGES[FEATURE_COLUMNS[j]]) for j in columns],
+                'counts': [a['histograms'][j].tolist() for j in columns]
+            },
+            'correlation': [rounded(corr[i, columns], 3) for i in columns],
+            'density': {
+                'bins': GRID_BINS,
+                'pairs': [[FEATURE_COLUMNS[i][:-len(' Rating')], FEATURE_COLUMNS[j][:-len(' Rating')]] for _, i, j in pairs],
+                'counts': [a['grids'][p].ravel().tolist() for p, _, _ in pairs]
+            }
+        }
+
+
+# Stats for the catalogs in a CatalogCache, kept in step with each catalog's generation
+class TasteAnalytics:
+
+    def __init__(self, catalog_cache, compiled_dir=COMPILED_DIR):
+        self.catalog_cache = catalog_cache
+        self.compiled_dir = compiled_dir
+        self.counts = {'hits': 0, 'current': 0, 'appended': 0, 'updated': 0, 'built': 0}
+        self.sync_seconds = 0.0
+        # (user_abbrev, name) -> (catalog the stats were synced to, TasteStats)
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def path(self, user_abbrev, name):
+        return os.path.join(self.compiled_dir, f"{user_abbrev}_playlists", f"{name}.stats") if self.compiled_dir else None
+
+    # TasteStats of a catalog, None if the catalog isn't documented
+    def get(self, user_abbrev, name):
+        entry = self.catalog_cache.get(user_abbrev, name)
+        if entry is None:
+            return None
+        key = (user_abbrev, name)
+        with self._lock:
+            cached = self._stats.get(key)
+        if cached is not None and cached[0] is entry.catalog:
+            self.counts['hits'] += 1
+            return cached[1]
+
+        path = self.path(*key)
+        with self._sync_lock, generation_lock(path), span('taste_stats'):
+            with self._lock:
+                cached = self._stats.get(key)
+            if cached is not None and cached[0] is entry.catalog:
+                self.counts['hits'] += 1
+                return cached[1]
+
+            start = time.perf_counter()
+            # ours (and the catalog they were counted from) if we have them, otherwise whatever was saved
+            if cached is not None:
+                stats, previous = cached[1].copy(), cached[0]
+            else:
+                stats, previous = self._read(path), None
+            how = stats.sync(entry.catalog, previous)
+            if path is not None and how != 'current':
+                try:
+                    stats.write(path)
+                except OSError as e:
+                    logging.warning(f"Couldn't save taste stats for {key}: {e}")
+            with self._lock:
+                self._stats[key] = (entry.catalog, stats)
+            self.counts[how] += 1
+            self.sync_seconds += time.perf_counter() - start
+            logging.debug(f"Taste stats for {key}: {how} in {time.perf_counter() - start:.3f}s")
+            return stats
+
+    def _read(self, path):
+        if path is None or not os.path.exists(path):
+            return TasteStats()
+        try:
+            return TasteStats.read(path)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring {path}: {e}")
+            return TasteStats()
+
+    def stats(self):
+        return dict(self.counts, catalogs=len(self._stats), sync_seconds=round(self.sync_seconds, 3))
@@ -0,0 +1,225 @@
+from spotipy.oauth2 import SpotifyOAuth
+import spotipy
+import sqlite3
+import threading
+import logging
+import time
+import os
+
+"""
+Spotify tokens and OAuth states in a small SQLite file, plus a background thread that refreshes tokens
+before they expire.
+
+Keeping them in SQLite instead of dicts means they survive a restart and every gunicorn worker sees the
+same logins. Each worker runs its own refresh thread, but a refresh has to be claimed with one UPDATE
+first, so only one worker refreshes a given token. Requests only ever read the stored token and get a cached
+spotipy client back, they never refresh anything themselves. OAuth states expire after OAUTH_STATE_TTL seconds.
+A login nobody has used for TOKEN_IDLE_TTL seconds is dropped instead of being refreshed forever, and so is one
+whose refresh failed TOKEN_MAX_FAILURES times in a row (revoked access), that user just has to log in again.
+"""
+
+REDIRECT_URI = os.environ.get('SPOTIFY_REDIRECT_URI', 'https://seamusmcn-github-io.onrender.com/callback')
+# point the clients somewhere else (benchmark.py's fake spotify), must end with a /
+SPOTIFY_API_PREFIX = os.environ.get('SPOTIFY_API_PREFIX')
+SCOPE = 'user-library-read playlist-read-private user-read-currently-playing user-read-playback-state user-modify-playback-state playlist-modify-private playlist-modify-public'
+TOKEN_DB = os.environ.get('TOKEN_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tokens.db'))
+TOKEN_REFRESH_MARGIN = float(os.environ.get('TOKEN_REFRESH_MARGIN', 600))  # refresh this many seconds before expiry
+TOKEN_REFRESH_INTERVAL = float(os.environ.get('TOKEN_REFRESH_INTERVAL', 60))
+OAUTH_STATE_TTL = float(os.environ.get('OAUTH_STATE_TTL', 600))
+TOKEN_IDLE_TTL = float(os.environ.get('TOKEN_IDLE_TTL', 30 * 24 * 3600))
+TOKEN_MAX_FAILURES = int(os.environ.get('TOKEN_MAX_FAILURES', 5))
+# last_used is written at most this often per login, not on every request
+LAST_USED_RESOLUTION = 60
+# how long a worker holds a refresh claim before another worker may try
+REFRESH_CLAIM_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    user_id TEXT PRIMARY KEY,
+    user_abbrev TEXT NOT NULL,
+    access_token TEXT NOT NULL,
+    refresh_token TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    claimed_until REAL NOT NULL DEFAULT 0,
+    last_used REAL NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS oauth_states (
+    state TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    redirect_uri TEXT NOT NULL,
+    user_abbrev TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+# (client id, client secret) for S / C, both from CLIENT_ID_* / SPOTIFY_CLIENT_SECRET_*
+def client_credentials(user_abbrev):
+    return os.environ.get(f'CLIENT_ID_{user_abbrev}'), os.environ.get(f'SPOTIFY_CLIENT_SECRET_{user_abbrev}')
+
+
+class TokenManager:
+
+    def __init__(self, db_path=TOKEN_DB, refresh_margin=TOKEN_REFRESH_MARGIN, interval=TOKEN_REFRESH_INTERVAL,
+                 state_ttl=OAUTH_STATE_TTL, idle_ttl=TOKEN_IDLE_TTL, max_failures=TOKEN_MAX_FAILURES):
+        self.db_path = db_path
+        self.refresh_margin = refresh_margin
+        self.interval = interval
+        self.state_ttl = state_ttl
+        self.idle_ttl = idle_ttl
+        self.max_failures = max_failures
+        self.refreshed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+            # tokens.db files from before these columns, existing logins count as used now
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(tokens)')}
+            if 'last_used' not in columns:
+                db.execute('ALTER TABLE tokens ADD COLUMN last_used REAL NOT NULL DEFAULT 0')
+                db.execute('UPDATE tokens SET last_used = ?', (time.time(),))
+            if 'failures' not in columns:
+                db.execute('ALTER TABLE tokens ADD COLUMN failures INTEGER NOT NULL DEFAULT 0')
+            db.commit()
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=10)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def _execute(self, sql, params=()):
+        db = self._connect()
+        try:
+            with db:
+                return db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+
+    # OAuth states, one per login attempt
+    def put_state(self, state, client_id, redirect_uri, user_abbrev):
+        self._execute('INSERT OR REPLACE INTO oauth_states VALUES (?, ?, ?, ?, ?)',
+                      (state, client_id, redirect_uri, user_abbrev, time.time()))
+
+    # The state's data (and forget it), None if it's unknown or expired
+    def pop_state(self, state):
+        rows = self._execute('DELETE FROM oauth_states WHERE state = ? RETURNING *', (state,))
+        if not rows or time.time() - rows[0]['created'] > self.state_ttl:
+            return None
+        return dict(rows[0])
+
+    def save_token(self, user_id, user_abbrev, token_info):
+        self._execute('INSERT INTO tokens (user_id, user_abbrev, access_token, refresh_token, expires_at, last_used) '
+                      'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET user_abbrev = excluded.user_abbrev, '
+                      'access_token = excluded.access_token, refresh_token = excluded.refresh_token, '
+                      'expires_at = excluded.expires_at, claimed_until = 0, failures = 0',
+                      (user_id, user_abbrev, token_info['access_token'], token_info['refresh_token'],
+                       token_info['expires_at'], time.time()))
+
+    def get_token(self, user_id):
+        rows = self._execute('SELECT * FROM tokens WHERE user_id = ?', (user_id,))
+        return dict(rows[0]) if rows else None
+
+    def __contains__(self, user_id):
+        return bool(user_id) and self.get_token(user_id) is not None
+
+    # Cached spotipy client for a logged in user, (None, None) if we don't know them
+    def client(self, user_id):
+        token = self.get_token(user_id) if user_id else None
+        if token is None:
+            return None, None
+        if token['expires_at'] < time.time():
+            # only happens if the refresh thread fell behind (e.g. the server was asleep), let it catch up
+            logging.warning("Token expired before it was refreshed, waking the refresher")
+            self._wake.set()
+        now = time.time()
+        if token['last_used'] < now - LAST_USED_RESOLUTION:
+            self._execute('UPDATE tokens SET last_used = ? WHERE user_id = ?', (now, user_id))
+
+        with self._lock:
+            cached = self._clients.get(user_id)
+            if cached is None or cached[0] != token['access_token']:
+                sp = spotipy.Spotify(auth=token['access_token'])
+                if SPOTIFY_API_PREFIX:
+                    sp.prefix = SPOTIFY_API_PREFIX
+                cached = (token['access_token'], sp)
+                self._clients[user_id] = cached
+        return cached[1], token['user_abbrev']
+
+    # Refresh every token expiring within refresh_margin that this worker manages to claim
+    def refresh_due(self):
+        now = time.time()
+        # logins nobody uses anymore aren't worth refreshing
+        idle = self._execute('DELETE FROM tokens WHERE last_used < ? RETURNING user_id', (now - self.idle_ttl,))
+        if idle:
+            self.dropped += len(idle)
+            logging.info(f"Dropped {len(idle)} idle login(s)")
+        due = self._execute('SELECT user_id FROM tokens WHERE expires_at < ?', (now + self.refresh_margin,))
+        for row in due:
+            claimed = self._execute('UPDATE tokens SET claimed_until = ? WHERE user_id = ? AND claimed_until < ? '
+                                    'AND expires_at < ? RETURNING *',
+                                    (now + REFRESH_CLAIM_SECONDS, row['user_id'], now, now + self.refresh_margin))
+            if claimed:
+                self._refresh(dict(claimed[0]))
+
+        # drop login attempts nobody came back from
+        self._execute('DELETE FROM oauth_states WHERE created < ?', (now - self.state_ttl,))
+
+    def _refresh(self, token):
+        try:
+            client_id, client_secret = client_credentials(token['user_abbrev'])
+            sp_oauth = SpotifyOAuth(client_id=client_id, client_secret=client_secret, redirect_uri=REDIRECT_URI)
+            new_token = sp_oauth.refresh_access_token(token['refresh_token'])
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"Token refresh failed for a {token['user_abbrev']} login: {e}")
+            # the claim runs out and it's retried, until it has failed max_failures times in a row
+            rows = self._execute('UPDATE tokens SET failures = failures + 1 WHERE user_id = ? RETURNING failures',
+                                 (token['user_id'],))
+            if rows and rows[0]['failures'] >= self.max_failures:
+                self._execute('DELETE FROM tokens WHERE user_id = ?', (token['user_id'],))
+                self.dropped += 1
+                logging.warning(f"Dropped a {token['user_abbrev']} login after {rows[0]['failures']} failed refreshes")
+            return
+        # spotify doesn't always send a new refresh token, keep the old one then
+        new_token['refresh_token'] = new_token.get('refresh_token') or token['refresh_token']
+        self.save_token(token['user_id'], token['user_abbrev'], new_token)
+        self.refreshed += 1
+        logging.debug(f"Refreshed a {token['user_abbrev']} token, good for {new_token['expires_at'] - time.time():.0f}s")
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh_due()
+            except Exception as e:
+                logging.error(f"Token refresher: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    # Start the background refresh thread (once per process)
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stats(self):
+        rows = self._execute('SELECT COUNT(*) AS users, MIN(expires_at) AS next_expiry FROM tokens')
+        states = self._execute('SELECT COUNT(*) AS states FROM oauth_states')
+        next_expiry = rows[0]['next_expiry']
+        return {
+            'users': rows[0]['users'],
+            'pending_states': states[0]['states'],
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'next_expiry_in': None if next_expiry is None else round(next_expiry - time.time(), 1),
+        }